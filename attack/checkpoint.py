@@ -0,0 +1,147 @@
+"""
+Saves the state of a running Bleichenbacher attack to disk so it can be resumed later.
+
+The attack only needs the blinding value s0, the last s_i, the set of possible solutions M
+and the number of the next iteration to continue, so a checkpoint is a small JSON file.
+M is stored in the binary form of `DisjointSegments.to_bytes`, in base64. The checkpoints which stored it
+with `DisjointSegments.serialize` still load.
+"""
+
+from attack.disjoint_segments import DisjointSegments
+from dataclasses import dataclass
+from typing import Protocol
+import json
+import os
+import time
+
+CHECKPOINT_INTERVAL = 10.0  # seconds between two periodic checkpoints
+
+
+class Attack(Protocol):
+    N: int
+    E: int
+    ct: int
+    C: int
+    s0: int
+    s_list: list[int]
+    M: DisjointSegments
+    iteration: int
+
+
+@dataclass
+class Checkpoint:
+    """
+    The state of an attack after its last completed iteration.
+    """
+
+    N: int
+    E: int
+    ct: int
+    s0: int
+    last_s: int
+    M: DisjointSegments
+    iteration: int
+
+    @classmethod
+    def of(cls, attack: Attack) -> "Checkpoint":
+        """
+        Returns a checkpoint of the attack's current state.
+        """
+        return cls(
+            attack.N,
+            attack.E,
+            attack.ct,
+            attack.s0,
+            attack.s_list[-1],
+            attack.M,
+            attack.iteration,
+        )
+
+    def restore(self, attack: Attack) -> None:
+        """
+        Puts the attack in the state saved in the checkpoint.
+
+        Args:
+            attack (Attack): An attack created with the same public key and ciphertext.
+
+        Raises:
+            ValueError: If the checkpoint belongs to another key or ciphertext.
+        """
+        if (attack.N, attack.E, attack.ct) != (self.N, self.E, self.ct):
+            raise ValueError("checkpoint belongs to another key or ciphertext")
+        attack.s0 = self.s0
+        attack.C = self.ct * pow(self.s0, self.E, self.N) % self.N
+        attack.s_list = [self.s0] if self.last_s == self.s0 else [self.s0, self.last_s]
+        attack.M = DisjointSegments(self.M)
+        attack.iteration = self.iteration
+
+    def serialize(self) -> str:
+        """
+        Returns a JSON serialized version of the checkpoint.
+        """
+        return json.dumps(
+            {
+                "N": self.N,
+                "E": self.E,
+                "ct": self.ct,
+                "s0": self.s0,
+                "last_s": self.last_s,
+                "M": self.M.to_base64(),
+                "iteration": self.iteration,
+            }
+        )
+
+    @classmethod
+    def deserialize(cls, data: str) -> "Checkpoint":
+        """
+        Returns a Checkpoint object from a JSON serialized string.
+        """
+        fields = json.loads(data)
+        fields["M"] = DisjointSegments.deserialize(fields["M"])
+        return cls(**fields)
+
+
+def save_checkpoint(path: str, checkpoint: Checkpoint) -> None:
+    """
+    Writes the checkpoint to `path`. The file is replaced atomically,
+    so a crash while saving leaves the previous checkpoint intact.
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        file.write(checkpoint.serialize())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str) -> Checkpoint:
+    """
+    Reads a checkpoint written by `save_checkpoint`.
+    """
+    with open(path, "r") as file:
+        return Checkpoint.deserialize(file.read())
+
+
+class Checkpointer:
+    """
+    Saves an attack's state to a file at most once every `interval` seconds.
+    """
+
+    def __init__(self, path: str, interval: float = CHECKPOINT_INTERVAL) -> None:
+        self.path = path
+        self.interval = interval
+        self.last_save = float("-inf")
+
+    def save(self, attack: Attack) -> None:
+        """
+        Saves the attack's state right away.
+        """
+        save_checkpoint(self.path, Checkpoint.of(attack))
+        self.last_save = time.monotonic()
+
+    def maybe_save(self, attack: Attack) -> None:
+        """
+        Saves the attack's state if the last checkpoint is older than the interval.
+        """
+        if time.monotonic() - self.last_save >= self.interval:
+            self.save(attack)
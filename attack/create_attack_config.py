@@ -5,15 +5,15 @@ import json
 
 
 # ! only for testing
-def get_public() -> tuple[int, int]:
-    with open("public_key.rsa", "rb") as key_file:
+def get_public(path: str = "public_key.rsa") -> tuple[int, int]:
+    with open(path, "rb") as key_file:
         pub_key = RSA.import_key(key_file.read())
     return pub_key.n, pub_key.e
 
 
-def get_cipher(to_cypher: str) -> int:
+def get_cipher(to_cypher: str, path: str = "public_key.rsa") -> int:
     msg = to_cypher.encode("utf-8")
-    with open("public_key.rsa", "rb") as key_file:
+    with open(path, "rb") as key_file:
         pub_key = RSA.import_key(key_file.read())
     cipher_rsa = PKCS1_v1_5.new(pub_key)
 
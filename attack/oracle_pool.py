@@ -0,0 +1,517 @@
+from attack.backends import OracleBackend
+from attack.oracle import ServerClosed, SendBuffer
+from collections import deque
+from dataclasses import dataclass
+from heapq import heappush, heappop
+from time import perf_counter
+from typing import Iterable
+from utils.protocol import KEY_ACK, key_hello
+import asyncio
+
+LATENCY_SMOOTHING = 0.1  # the weight of a new sample in the moving average
+HEDGE_SAMPLES = (
+    1000  # the number of recent reply times the hedging threshold is computed from
+)
+HEDGE_MIN_SAMPLES = 50  # no hedging before this many replies were timed
+HEDGE_REFRESH = 0.25  # seconds between recomputations of the hedging threshold
+
+
+@dataclass
+class ConnectionStats:
+    """A snapshot of a connection's load, see `OraclePool.stats`."""
+
+    host: str
+    port: int
+    latency: float
+    in_flight: int
+    answered: int
+    reconnects: int
+    closed: bool
+    gone: bool
+
+
+class OracleConnection:
+    """
+    A single connection to an oracle server, driven by the pool's event loop.
+
+    Queries may be sent without waiting for the previous answers, the server answers them in order
+    so every reply resolves the oldest pending future.
+
+    `latency` is a moving average of the time every query spent at the head of the connection's queue,
+    so `(len(pending) + 1) * latency` estimates how long a new query would take to be answered.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        reply_times: deque[float] | None = None,
+        key_id: str | None = None,
+    ) -> None:
+        """
+        Args:
+            host (str): The host of the server.
+            port (int): The port of the server.
+            reply_times (deque[float] | None, optional): Where the time from sending every query
+                to its reply is recorded, may be shared between connections. Defaults to None.
+            key_id (str | None, optional): The server's key to check the queries with,
+                picked again on every reconnection. Defaults to None, for its default key.
+        """
+        self.host = host
+        self.port = port
+        self.key_id = key_id
+        self.reply_times = (
+            reply_times if reply_times is not None else deque(maxlen=HEDGE_SAMPLES)
+        )
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        # (future, send time) of every query that was not answered yet
+        self.pending: deque[tuple[asyncio.Future, float]] = deque()
+        self.out = SendBuffer()  # the queries sent since the last flush
+        self.closed = True
+        # True once reconnecting failed, the server is never tried again
+        self.gone = False
+        self.reader_task: asyncio.Task | None = None
+        self.reconnect_task: asyncio.Task | None = None
+        self.latency = 0.0
+        self.last_reply = 0.0
+        self.answered = 0
+        self.reconnects = 0
+
+    @property
+    def cost(self) -> float:
+        """
+        The expected time until a query sent now would be answered.
+        """
+        return (len(self.pending) + 1) * self.latency
+
+    def stats(self) -> ConnectionStats:
+        return ConnectionStats(
+            self.host,
+            self.port,
+            self.latency,
+            len(self.pending),
+            self.answered,
+            self.reconnects,
+            self.closed,
+            self.gone,
+        )
+
+    async def connect(self) -> None:
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.key_id is not None:
+            self.writer.write(key_hello(self.key_id))
+            if await self.reader.readexactly(len(KEY_ACK)) != KEY_ACK:
+                self.writer.close()
+                raise ConnectionRefusedError(
+                    f"{self.host}:{self.port} does not host the key {self.key_id!r}"
+                )
+        self.out.clear()
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self._read_replies())
+
+    async def reconnect(self, retries: int, backoff: float) -> None:
+        """
+        Tries to connect again, waiting `backoff` seconds before the first attempt
+        and twice as long before every attempt after it.
+        """
+        delay = backoff
+        for _ in range(retries):
+            await asyncio.sleep(delay)
+            try:
+                await self.connect()
+                self.reconnects += 1
+                return
+            except OSError:
+                delay *= 2
+
+        self.gone = True
+
+    def mark_closed(self) -> None:
+        """
+        Resolves all the pending futures with None, their queries will never be answered.
+        """
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+        while self.pending:
+            self.pending.popleft()[0].set_result(None)
+
+    async def _read_replies(self) -> None:
+        """
+        Resolves the pending futures with the server's answers, until the server closes.
+        """
+        try:
+            while True:
+                data = await self.reader.read(max(1, len(self.pending)))
+                if not data:
+                    break
+                now = perf_counter()
+                for answer in data:
+                    future, sent_at = self.pending.popleft()
+                    future.set_result(answer == 1)
+                    self._record_latency(now - max(sent_at, self.last_reply))
+                    self.reply_times.append(now - sent_at)
+                    self.last_reply = now
+        except ConnectionError:
+            pass
+
+        self.mark_closed()
+
+    def _record_latency(self, sample: float) -> None:
+        self.answered += 1
+        if self.answered == 1:
+            self.latency = sample
+        else:
+            self.latency += LATENCY_SMOOTHING * (sample - self.latency)
+
+    def send(self, num: int) -> asyncio.Future:
+        """
+        Queues a ciphertext to the server, it is sent on the next `flush`.
+
+        Returns:
+            asyncio.Future: Resolves to the oracle's answer, or to None if the server closed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        if self.closed:
+            future.set_result(None)
+            return future
+
+        self.out.put(num)
+        self.pending.append((future, perf_counter()))
+        return future
+
+    async def flush(self) -> None:
+        """
+        Sends all the queued ciphertexts in a single write.
+        """
+        if self.closed:
+            return
+        try:
+            if len(self.out):
+                self.writer.write(self.out.pop())
+            await self.writer.drain()
+        except ConnectionError:
+            self.mark_closed()
+
+    def close(self) -> None:
+        for task in (self.reader_task, self.reconnect_task):
+            if task is not None:
+                task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class OraclePool(OracleBackend):
+    """
+    Drives the connections to many oracle servers from a single asyncio event loop,
+    with one coroutine per connection and up to `window` queries in flight on each of them.
+
+    Every query goes to the least loaded connection, judged by its moving-average latency
+    and the number of queries in flight on it, so slow servers get fewer queries than fast ones.
+
+    A connection that dies has its unanswered queries sent again through the other connections,
+    and is reconnected in the background. ServerClosed is only raised once every server is gone.
+
+    With hedging enabled, a query that waits longer than the given percentile of the recent reply
+    times is sent to a second server as well, and the first answer to arrive is used.
+    """
+
+    def __init__(
+        self,
+        N: int,
+        E: int,
+        hosts: list[str],
+        ports: list[int],
+        window: int = 1,
+        retries: int = 5,
+        backoff: float = 0.1,
+        hedge_percentile: float | None = None,
+        key_id: str | None = None,
+    ) -> None:
+        """
+        Connects to all the servers, see `_connect_all`.
+
+        Args:
+            N (int): The modulus of the RSA public key.
+            E (int): The public exponent of the RSA public key.
+            hosts (list[str]): The hosts of the servers.
+            ports (list[int]): The ports of the servers, matching `hosts`.
+            window (int, optional): The maximal number of unanswered queries per connection. Defaults to 1.
+            retries (int, optional): The number of reconnection attempts before giving up on a server. Defaults to 5.
+            backoff (float, optional): The delay in seconds before the first reconnection attempt,
+                doubled after every failed attempt. Defaults to 0.1.
+            hedge_percentile (float | None, optional): The percentile (0-100) of the reply times after which
+                a query is hedged, None disables hedging. Defaults to None.
+            key_id (str | None, optional): The servers' key to check the queries with. Defaults to None, for their default key.
+        """
+        assert window >= 1
+        self.N = N
+        self.E = E
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.sent = 0
+        self.retried = 0  # queries that were sent again because their server died
+        self.hedge_percentile = hedge_percentile
+        self.hedged = 0  # extra queries sent to a second server, not counted in `sent`
+        self.reply_times: deque[float] = deque(maxlen=HEDGE_SAMPLES)
+        self.threshold: float | None = None
+        self.threshold_time = 0.0
+        self.conns = [
+            OracleConnection(host, port, self.reply_times, key_id)
+            for host, port in zip(hosts, ports, strict=True)
+        ]
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self._connect_all())
+        except OSError:
+            self.loop.close()
+            raise
+
+    async def _connect_all(self) -> None:
+        """
+        Connects to all the servers at once. The servers which cannot be reached are reconnected
+        in the background, like the connections which die later, so the attack starts with the others.
+
+        Raises:
+            OSError: If none of the servers could be reached.
+        """
+        results = await asyncio.gather(
+            *(conn.connect() for conn in self.conns), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, OSError):
+                raise result
+        if all(isinstance(result, OSError) for result in results):
+            raise results[0]
+        for conn, result in zip(self.conns, results):
+            if isinstance(result, OSError):
+                conn.mark_closed()
+                conn.reconnect_task = asyncio.ensure_future(
+                    conn.reconnect(self.retries, self.backoff)
+                )
+
+    async def live_conns(self) -> list[OracleConnection]:
+        """
+        Returns the healthy connections, starts reconnecting the dead ones,
+        and waits for a reconnection if no connection is healthy.
+
+        Raises:
+            ServerClosed: If every server is gone.
+        """
+        while True:
+            for conn in self.conns:
+                if conn.closed and not conn.gone:
+                    if conn.reconnect_task is None or conn.reconnect_task.done():
+                        conn.reconnect_task = asyncio.ensure_future(
+                            conn.reconnect(self.retries, self.backoff)
+                        )
+
+            live = [conn for conn in self.conns if not conn.closed]
+            if live:
+                return live
+
+            reconnecting = [conn.reconnect_task for conn in self.conns if not conn.gone]
+            if not reconnecting:
+                raise ServerClosed
+            await asyncio.wait(reconnecting, return_when=asyncio.FIRST_COMPLETED)
+
+    @staticmethod
+    def least_loaded(conns: list[OracleConnection]) -> OracleConnection:
+        return min(conns, key=lambda conn: conn.cost)
+
+    def hedge_threshold(self) -> float | None:
+        """
+        Returns how long a query may wait before it is hedged, or None if it should not be hedged.
+        The threshold is recomputed from the recent reply times at most every HEDGE_REFRESH seconds.
+        """
+        if self.hedge_percentile is None or len(self.reply_times) < HEDGE_MIN_SAMPLES:
+            return None
+
+        now = perf_counter()
+        if self.threshold is None or now - self.threshold_time > HEDGE_REFRESH:
+            samples = sorted(self.reply_times)
+            position = round(self.hedge_percentile / 100 * (len(samples) - 1))
+            self.threshold = samples[position]
+            self.threshold_time = now
+        return self.threshold
+
+    async def wait_answer(
+        self,
+        conn: OracleConnection,
+        future: asyncio.Future,
+        num: int,
+        sent_at: float,
+        threshold: float | None,
+    ) -> bool | None:
+        """
+        Waits for the answer to a query, hedging it on another server if it is late.
+
+        Args:
+            conn (OracleConnection): The connection the query was sent on.
+            future (asyncio.Future): The future returned when the query was sent.
+            num (int): The ciphertext, in case it has to be sent again.
+            sent_at (float): When the query was sent, by `perf_counter`.
+            threshold (float | None): See `hedge_threshold`.
+
+        Returns:
+            bool | None: The oracle's answer, or None if no server answered it.
+        """
+        if threshold is None:
+            return await future
+
+        remaining = threshold - (perf_counter() - sent_at)
+        if remaining > 0:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+        others = [
+            other for other in self.conns if other is not conn and not other.closed
+        ]
+        if not others:
+            return await future
+
+        other = self.least_loaded(others)
+        hedge = other.send(num)
+        self.hedged += 1
+        await other.flush()
+        for first in asyncio.as_completed((future, hedge)):
+            answer = await first
+            if answer is not None:
+                return answer
+        return None
+
+    def stats(self) -> list[ConnectionStats]:
+        """
+        Returns the load of every connection, for inspection.
+        """
+        return [conn.stats() for conn in self.conns]
+
+    async def find_first(self, C: int, candidates: Iterable[int]) -> int:
+        """
+        Searches the candidates for the first s such that C * s^e mod N is PKCS conforming.
+
+        The candidates are handed out to the connections in order, and the result is the first
+        conforming candidate in that order, the same as searching them one by one.
+        A connection only takes another candidate while it is the least loaded one,
+        but it always keeps at least one query in flight.
+        Late queries are hedged if the pool was created with a `hedge_percentile`.
+        Replies to queries sent after the hit are left to be consumed in the background.
+        Queries whose server died are sent again through the other servers.
+
+        Args:
+            C (int): The ciphertext to multiply.
+            candidates (Iterable[int]): The values of s to try, in order.
+
+        Returns:
+            int: The first conforming s.
+        """
+        stream = enumerate(candidates)
+        exhausted = False
+        retry: list[tuple[int, int]] = []  # heap of (position in the stream, s)
+        best: tuple[int, int] | None = None  # (position in the stream, s)
+
+        def must_retry() -> bool:
+            return bool(retry) and (best is None or retry[0][0] < best[0])
+
+        def next_query() -> tuple[int, int] | None:
+            nonlocal exhausted
+            if must_retry():
+                return heappop(retry)
+            if best is not None or exhausted:
+                return None
+            item = next(stream, None)
+            exhausted = item is None
+            return item
+
+        def is_least_loaded(
+            conn: OracleConnection, live: list[OracleConnection]
+        ) -> bool:
+            return all(conn.cost <= other.cost for other in live if not other.closed)
+
+        async def worker(conn: OracleConnection, live: list[OracleConnection]) -> None:
+            nonlocal best
+            # (position in the stream, s, ciphertext, future, send time)
+            in_flight: deque[tuple[int, int, int, asyncio.Future, float]] = deque()
+            while True:
+                while (
+                    len(in_flight) < self.window
+                    and (not conn.pending or is_least_loaded(conn, live))
+                    and (item := next_query())
+                ):
+                    index, s = item
+                    num = C * pow(s, self.E, self.N) % self.N
+                    in_flight.append((index, s, num, conn.send(num), perf_counter()))
+                    self.sent += 1
+                await conn.flush()
+
+                if not in_flight or (best is not None and in_flight[0][0] > best[0]):
+                    return  # nothing that was sent here can precede the hit
+
+                index, s, num, future, sent_at = in_flight[0]
+                answer = await self.wait_answer(
+                    conn, future, num, sent_at, self.hedge_threshold()
+                )
+                if answer is None:  # the server died, the others will answer instead
+                    for index, s, *_ in in_flight:
+                        heappush(retry, (index, s))
+                        self.retried += 1
+                    return
+
+                in_flight.popleft()
+                if answer and (best is None or index < best[0]):
+                    best = (index, s)
+
+        while True:
+            live = await self.live_conns()
+            workers = [asyncio.ensure_future(worker(conn, live)) for conn in live]
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+
+            if not must_retry() and (best is not None or exhausted):
+                break
+
+        if best is None:
+            raise ValueError("Iterator search failed")
+        return best[1]
+
+    def search(self, C: int, candidates: Iterable[int]) -> int:
+        """
+        Blocking version of `find_first`, for the synchronous attack code.
+        """
+        return self.loop.run_until_complete(self.find_first(C, candidates))
+
+    async def ask(self, num: int) -> bool:
+        """
+        Queries a single ciphertext through the least loaded healthy server.
+        """
+        while True:
+            conn = self.least_loaded(await self.live_conns())
+            future = conn.send(num)
+            sent_at = perf_counter()
+            self.sent += 1
+            await conn.flush()
+            answer = await self.wait_answer(
+                conn, future, num, sent_at, self.hedge_threshold()
+            )
+            if answer is not None:
+                return answer
+            self.retried += 1
+
+    def oracle(self, num: int) -> bool:
+        """
+        Blocking version of `ask`, for the synchronous attack code.
+        """
+        return self.loop.run_until_complete(self.ask(num))
+
+    def close(self) -> None:
+        for conn in self.conns:
+            conn.close()
+        self.loop.run_until_complete(asyncio.sleep(0))  # let the cancellations run
+        self.loop.close()
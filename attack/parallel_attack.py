@@ -1,9 +1,14 @@
 from attack.multiserver_attacker import MultiServerAttacker
+from attack.backends import OracleBackend, LocalKeyBackend
+from attack.oracle_pool import OraclePool
+from attack.transcript import RecordingOracle, ReplayOracle, read_transcript
 from attack.create_attack_config import get_cipher, get_public
 from multiprocessing import Process, Pool
 from Crypto.Util.number import long_to_bytes, bytes_to_long
 from utils.LLL.lll import LLLWrapper
 from pathlib import Path
+from functools import partial
+from typing import Callable
 import argparse
 
 
@@ -38,6 +43,19 @@ def attack_arguments_parser() -> argparse.Namespace:
         "-p", "--port", help="sets the server's base port, defaults to 8001"
     )
     parser.add_argument("--host", help="sets the server's host, defaults to localhost")
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="answers the queries in-process with private_key.rsa instead of the servers",
+    )
+    parser.add_argument(
+        "--record",
+        help="records the oracle's answers of attacker i to the transcript file <RECORD>.i",
+    )
+    parser.add_argument(
+        "--replay",
+        help="answers the queries of attacker i from the transcript file <REPLAY>.i instead of the servers",
+    )
     my_args = parser.parse_args()
     return my_args
 
@@ -52,9 +70,8 @@ class ParallelAttacker:
         N: int,
         E: int,
         ct: int,
-        attacker_amount: int,
-        hosts: list[str],
-        ports: list[int],
+        backends: list[Callable[[], OracleBackend]],
+        record: str | None = None,
     ) -> None:
         """
         Initializes the ParallelAttacker with necessary parameters.
@@ -63,48 +80,39 @@ class ParallelAttacker:
             N (int): The RSA modulus.
             E (int): The RSA public exponent.
             ct (int): The encrypted ciphertext.
-            attacker_amount (int): The number of attackers to use.
-            hosts (list[str]): List of hosts (IP addresses or domain names).
-            ports (list[int]): List of ports for the servers.
+            backends (list[Callable[[], OracleBackend]]): Creates the oracle backend of every attacker,
+                one attacker is started for each of them. They are called in the attackers' processes,
+                so they must be picklable, e.g. `partial(OraclePool, N, E, hosts, ports)`.
+            record (str | None, optional): Records the oracle's answers of attacker i to the transcript `<record>.i`.
+                Defaults to None.
         """
         self.N = N
         self.E = E
         self.ct = ct
-        self.hosts = hosts
-        self.ports = ports
-        self.attacker_count = attacker_amount
-
-    def _split_into_k_lists(self, K: int, input_lists: list[list]) -> list[tuple]:
-        """
-        Splits input lists into `K` chunks, where each chunk contains `K` elements.
+        self.backends = backends
+        self.attacker_count = len(backends)
+        self.record = record
 
-        Args:
-            K (int): The number of chunks to divide each list into.
-            input_lists (list[list]): A list of lists to be split.
-
-        Returns:
-            list[tuple]: A list of tuples, each containing K elements from the input lists.
+    def attacker_warper(self, index: int) -> tuple[range, int, int]:
         """
-        return_list = []
-        for lst in input_lists:
-            return_list.append([lst[i : i + K] for i in range(0, len(lst), K)])
-        return list(zip(*return_list))
-
-    def attacker_warper(
-        self, hosts: list[str], ports: list[int]
-    ) -> tuple[range, int, int]:
-        """
-        Wrapper function for executing the Bleichenbacher attack on a server with the provided hosts and ports.
+        Wrapper function for executing the Bleichenbacher attack with the attacker's oracle backend.
 
         Args:
-            hosts (list[str]): List of host IPs for the attack.
-            ports (list[int]): List of ports to use for the attack.
+            index (int): The number of the attacker.
 
         Returns:
             tuple[range, int, int]: The result of the attack, containing a range and two integers (s0 and si).
         """
+        backend = self.backends[index]()
+        if self.record:
+            backend = RecordingOracle(backend, f"{self.record}.{index}")
+
         attacker: MultiServerAttacker = MultiServerAttacker(
-            self.N, self.E, self.ct, hosts, ports, random_blinding=True
+            self.N,
+            self.E,
+            self.ct,
+            backend,
+            random_blinding=True,
         )
         print("in here")
         result = attacker.attack()
@@ -118,12 +126,7 @@ class ParallelAttacker:
             int: The decrypted plaintext message.
         """
         with Pool(self.attacker_count) as pool:
-            results = pool.starmap(
-                self.attacker_warper,
-                self._split_into_k_lists(
-                    len(self.ports) // self.attacker_count, [self.hosts, self.ports]
-                ),  # fix this
-            )
+            results = pool.map(self.attacker_warper, range(self.attacker_count))
 
         range_list = []
         s0_list = []
@@ -185,6 +188,23 @@ def vec_norm(vec: list[int]) -> int:
     return sum(x * x for x in vec)
 
 
+def split_into_k_lists(K: int, input_lists: list[list]) -> list[tuple]:
+    """
+    Splits input lists into `K` chunks, where each chunk contains `K` elements.
+
+    Args:
+        K (int): The number of chunks to divide each list into.
+        input_lists (list[list]): A list of lists to be split.
+
+    Returns:
+        list[tuple]: A list of tuples, each containing K elements from the input lists.
+    """
+    return_list = []
+    for lst in input_lists:
+        return_list.append([lst[i : i + K] for i in range(0, len(lst), K)])
+    return list(zip(*return_list))
+
+
 def main():
     """
     The main entry point of the program. Loads attack parameters, parses command-line arguments,
@@ -212,13 +232,31 @@ def main():
     PORTS = [base_port + i for i in range(num_of_servers)]
     N, E = get_public()
     C = get_cipher("hello world")
+    backends: list[Callable[[], OracleBackend]]
+    if my_args.replay:
+        # every attacker blinds the same ciphertext
+        C, _, _ = next(read_transcript(f"{my_args.replay}.0"))
+        backends = [
+            partial(ReplayOracle, f"{my_args.replay}.{i}")
+            for i in range(num_of_attackers)
+        ]
+    elif my_args.local:
+        backends = [
+            partial(LocalKeyBackend.from_file, "private_key.rsa")
+        ] * num_of_attackers
+    else:
+        backends = [
+            partial(OraclePool, N, E, hosts, ports)
+            for hosts, ports in split_into_k_lists(
+                num_of_servers // num_of_attackers, [HOSTS, PORTS]
+            )  # fix this
+        ]
     parallel = ParallelAttacker(
         N,
         E,
         C,
-        num_of_attackers,
-        HOSTS,
-        PORTS,
+        backends,
+        my_args.record,
     )
     parallel.attack()
 
@@ -0,0 +1,101 @@
+"""
+The candidates of steps 2.a and 2.b without the holes, after Bardou et al., "Efficient Padding Oracle Attacks
+on Cryptographic Hardware" (CRYPTO 2012).
+
+C * s^e is conforming iff m0 * s mod N is in [2B, 3B), that is iff 2B + rN <= m0 * s < 3B + rN for some r.
+For m0 in an interval [a, b] of M, the s which satisfy it for a given r form the window
+[ceil((2B + rN) / b), floor((3B - 1 + rN) / a)], and the s between two windows of every interval
+of M can never be conforming. The linear scan queries them anyway; `SkippingHoles` jumps over them.
+
+The narrower M, the narrower the windows: the holes matter most after trimming (see `attack.trimming`)
+and in the later 2.b steps, but the untrimmed 2.a already skips every s in (N / 2B, 2N / 3B).
+"""
+
+from heapq import merge
+from typing import Iterable, Iterator
+from utils.attack_utils import ceil_div
+
+
+class SkippingHoles:
+    """
+    Iterates, in increasing order from `start`, over the s for which m * s mod N can be conforming
+    for some m in M, and counts the s it skips.
+    """
+
+    def __init__(self, M: Iterable[range], B: int, N: int, start: int) -> None:
+        """
+        Args:
+            M (Iterable[range]): The intervals the blinded message may be in.
+            B (int): The value of the lsb in the second most significant byte of N.
+            N (int): The modulus of the RSA public key.
+            start (int): The first s to consider.
+        """
+        self.intervals = [(interval.start, interval.stop - 1) for interval in M]
+        self.B = B
+        self.N = N
+        self.start = start
+        # the skipped ranges of s, in increasing order
+        self.holes: list[range] = []
+
+    def windows(self, a: int, b: int) -> Iterator[tuple[int, int]]:
+        """
+        Yields the windows [low, high] of the s which can be conforming for some m in [a, b], from `start` on.
+        """
+        B, N = self.B, self.N
+        r = max(0, ceil_div(self.start * a - 3 * B + 1, N))
+        while (low := ceil_div(2 * B + r * N, b)) < N:
+            high = min((3 * B - 1 + r * N) // a, N - 1)
+            if low <= high and high >= self.start:
+                yield max(low, self.start), high
+            r += 1
+
+    def __iter__(self) -> Iterator[int]:
+        s = self.start
+        for low, high in merge(*(self.windows(a, b) for a, b in self.intervals)):
+            if high < s:
+                continue
+            if low > s:
+                self.holes.append(range(s, low))
+                s = low
+            while s <= high:
+                yield s
+                s += 1
+
+    def skipped_below(self, s: int) -> int:
+        """
+        Returns the number of candidates skipped before `s`, which the linear scan would have queried.
+        """
+        return sum(
+            min(hole.stop, s) - hole.start for hole in self.holes if hole.start < s
+        )
+
+
+if __name__ == "__main__":
+    from itertools import takewhile
+    from random import Random
+
+    # a toy modulus, the brute force scan checks every m of M against every s
+    B, N = 1 << 8, 65521
+    random = Random(0)
+    skipped = 0
+    for case in range(60):
+        M = []
+        low = random.randrange(2 * B, 3 * B - 80)
+        for _ in range(1 + case % 2):  # one interval, then two
+            start = random.randrange(low, low + 20)
+            M.append(range(start, start + random.randrange(1, 30)))
+            low = M[-1].stop + 1
+        start, limit = random.randrange(1, 2000), 4000
+        candidates = SkippingHoles(M, B, N, start)
+        skipping = list(takewhile(lambda s: s < limit, candidates))
+        assert skipping == sorted(set(skipping))
+        linear = [
+            s
+            for s in range(start, limit)
+            if any(2 * B <= m * s % N < 3 * B for interval in M for m in interval)
+        ]
+        # every s which is conforming for some m in M is kept
+        assert set(linear) <= set(skipping), (M, start)
+        assert candidates.skipped_below(limit) == limit - start - len(skipping)
+        skipped += candidates.skipped_below(limit)
+    assert skipped > 0
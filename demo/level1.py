@@ -1,8 +1,11 @@
 from attack.attacker import Attacker
+from attack.backends import TcpBackend
 from eval_server.ctf_params import N, E, level_1_C, level_1_name
 from eval_server.eval_client import send_answer
 
-attacker = Attacker(N, E, level_1_C, "localhost", 8001, random_blinding=True)
+attacker = Attacker(
+    N, E, level_1_C, TcpBackend(N, E, "localhost", 8001), random_blinding=True
+)
 blinded_C, blinding_s = attacker.blinding()
 print(f"{blinding_s=}")
 
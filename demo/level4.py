@@ -1,4 +1,5 @@
 from attack.attacker import Attacker
+from attack.backends import TcpBackend
 from eval_server.ctf_params import (
     N,
     E,
@@ -9,7 +10,9 @@ from eval_server.ctf_params import (
 )
 from eval_server.eval_client import send_answer
 
-attacker = Attacker(N, E, level_4_C, "localhost", 8001, random_blinding=True)
+attacker = Attacker(
+    N, E, level_4_C, TcpBackend(N, E, "localhost", 8001), random_blinding=True
+)
 attacker.s_list = [level_4_prev_s]
 attacker.M = level_4_M
 
@@ -1,4 +1,5 @@
 from attack.attacker import Attacker
+from attack.backends import TcpBackend
 from eval_server.ctf_params import (
     N,
     E,
@@ -9,11 +10,13 @@ from eval_server.ctf_params import (
 )
 from eval_server.eval_client import send_answer
 
-attacker = Attacker(N, E, level_5_C, "localhost", 8001, random_blinding=True)
+attacker = Attacker(
+    N, E, level_5_C, TcpBackend(N, E, "localhost", 8001), random_blinding=True
+)
 attacker.M = level_5_prev_M
 
 next_M = attacker.update_intervals(level_5_prev_s)
 
 print(f"{next_M=}")
 
-print(send_answer("demo", level_5_name, next_M))
+print(send_answer("demo", level_5_name, next_M.to_base64()))
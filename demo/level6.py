@@ -1,9 +1,10 @@
 from Crypto.Util.number import long_to_bytes
 from attack.attacker import Attacker
+from attack.backends import TcpBackend
 from eval_server.ctf_params import N, E, level_6_C, level_6_name
 from eval_server.eval_client import send_answer
 
-attacker = Attacker(N, E, level_6_C, "localhost", 8001)
+attacker = Attacker(N, E, level_6_C, TcpBackend(N, E, "localhost", 8001))
 
 r, _ = attacker.attack()
 message = list(r)[0]
@@ -1,4 +1,4 @@
-from utils.attack_utils import search_start, search_mulitiple_intervals
+from utils.attack_utils import ceil_div, search_start, search_mulitiple_intervals
 from utils.rsa import check_padding_private_key
 from attack.disjoint_segments import DisjointSegments
 from Crypto.PublicKey import RSA
@@ -9,17 +9,13 @@ from Crypto.PublicKey.RSA import RsaKey
 
 from eval_server.ctf_answers import level_2_answer, level_3_answer, level_4_answer
 
-
-def ceil_div(x: int, y: int) -> int:
-    return (x + y - 1) // y
-
-
 BITS_LENGTH = 1024
 E = 65537
 B = 1 << (BITS_LENGTH - 16)
 
 
 def string_to_DisjointSegments(M: str):
+    # the base64 binary form of DisjointSegments.to_base64, or the JSON of DisjointSegments.serialize
     return DisjointSegments.deserialize(M)
 
 
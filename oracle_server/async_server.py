@@ -0,0 +1,236 @@
+"""
+An event-driven oracle server, which serves many clients on the same port at once.
+
+`server.server_loop` serves one client at a time, so a second client on the same port waits
+until the first one disconnects. Here every connection is a coroutine on a single asyncio loop,
+which queues the client's queries, and the decryptions are shared fairly between the clients
+by `oracle_server.scheduler`, so the clients' queries are interleaved.
+It speaks the same protocol, including batch mode (see `utils.protocol`).
+It can also delay the replies to emulate a slower network, see `oracle_server.latency`.
+"""
+
+from dataclasses import dataclass
+from oracle_server.budget import PortBudget
+from oracle_server.keys import KeyRing
+from oracle_server.latency import DelayedWriter, Latency
+from oracle_server.metrics import ClientTable, PaddingChecker, WorkerMetrics
+from oracle_server.scheduler import QUEUE_LIMIT, ClientQueue, FairScheduler, Work
+from utils.protocol import (
+    CIPHERTEXT_SIZE,
+    BATCH_HELLO,
+    BATCH_ACK,
+    COUNT_SIZE,
+    MAX_BATCH,
+    KEY_ACK,
+    KEY_UNKNOWN,
+    parse_key_hello,
+)
+import asyncio
+import socket
+
+# the most read from a client at once
+READ_SIZE = 64 * CIPHERTEXT_SIZE
+
+
+class QueryCounter:
+    """
+    Counts the queries answered on a port, and prints the progress every 10000 queries when verbose.
+    """
+
+    def __init__(self, port: int | str, verbose: bool) -> None:
+        self.port = port
+        self.verbose = verbose
+        self.count = 0
+
+    def add(self, count: int) -> None:
+        previous = self.count
+        self.count += count
+        if self.verbose and (previous // 10000 != self.count // 10000):
+            print(f"server: {self.port} got {self.count} messages")
+
+
+def set_low_latency(sock: socket.socket) -> None:
+    """
+    Sends the small replies right away instead of coalescing them (Nagle's algorithm).
+    The queries are acknowledged by the replies which follow them, so delayed acknowledgements are left on.
+    Unix domain sockets do not coalesce, and are left as they are.
+    """
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+@dataclass
+class ClientState:
+    """
+    What a client negotiated on its connection.
+    """
+
+    decryptor: PaddingChecker
+    batch_mode: bool = False
+
+
+def parse_queries(
+    pending: bytearray, keys: KeyRing, state: ClientState
+) -> tuple[list[Work], int]:
+    """
+    Parses every complete query (or batch frame) at the start of `pending` into work for the scheduler.
+    The handshakes are handled right away, but their replies are queued behind the queries before them.
+
+    Args:
+        pending (bytearray): The bytes received from the client which were not parsed yet.
+        keys (KeyRing): The keys the client may pick from.
+        state (ClientState): The client's key and mode, updated by the handshakes in `pending`.
+
+    Returns:
+        tuple[list[Work], int]: The work, and the number of bytes of `pending` it was parsed from.
+    """
+    work: list[Work] = []
+    offset = 0
+    while True:
+        if not state.batch_mode:
+            if len(pending) - offset < CIPHERTEXT_SIZE:
+                break
+            data = bytes(pending[offset : offset + CIPHERTEXT_SIZE])
+            offset += CIPHERTEXT_SIZE
+            if data == BATCH_HELLO:
+                reply = BATCH_ACK + MAX_BATCH.to_bytes(COUNT_SIZE, "big")
+                work.append(Work(None, reply=reply))
+                state.batch_mode = True
+                continue
+            if (key_id := parse_key_hello(data)) is not None:
+                selected = keys.get(key_id)
+                if selected is None:
+                    work.append(Work(None, reply=KEY_UNKNOWN))
+                else:
+                    state.decryptor = selected
+                    work.append(Work(None, reply=KEY_ACK))
+                continue
+            work.append(Work(state.decryptor, [data]))
+        else:
+            if len(pending) - offset < COUNT_SIZE:
+                break
+            count = int.from_bytes(pending[offset : offset + COUNT_SIZE], "big")
+            if not 0 < count <= MAX_BATCH:
+                raise ConnectionError(f"invalid batch size {count}")
+            start = offset + COUNT_SIZE
+            end = start + count * CIPHERTEXT_SIZE
+            if len(pending) < end:
+                break
+            ciphertexts = [
+                bytes(pending[i : i + CIPHERTEXT_SIZE])
+                for i in range(start, end, CIPHERTEXT_SIZE)
+            ]
+            work.append(Work(state.decryptor, ciphertexts, batch=True))
+            offset = end
+    return work, offset
+
+
+async def serve_client(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    keys: KeyRing,
+    counter: QueryCounter,
+    scheduler: FairScheduler,
+    metrics: WorkerMetrics | None = None,
+    latency: Latency | None = None,
+    weights: dict[str, float] | None = None,
+    clients: ClientTable | None = None,
+) -> None:
+    """
+    Serves a single client until it disconnects, or until the budget refuses its queries.
+    Its queries are decrypted by `scheduler`, in turns with the other clients',
+    and the replies of a turn are sent with a single write, which is delayed by `latency` if one is given.
+    """
+    addr = writer.get_extra_info("peername")
+    if metrics is not None:
+        metrics.connected()
+    set_low_latency(writer.get_extra_info("socket"))
+    pending = bytearray()
+    state = ClientState(keys.default)
+    delayed = DelayedWriter(writer, latency) if latency is not None else None
+    host, peer = "", addr or "unix"
+    if isinstance(addr, tuple):
+        host, peer = addr[0], f"{addr[0]}:{addr[1]}"
+    weight = weights.get(host, 1.0) if weights else 1.0
+
+    def stop_reading() -> None:
+        writer.transport.pause_reading()
+        reader.feed_eof()
+
+    send = delayed.write if delayed is not None else writer.write
+    client = ClientQueue(peer, weight, send, clients, stop_reading)
+    try:
+        while chunk := await reader.read(READ_SIZE):
+            pending += chunk
+            work, used = parse_queries(pending, keys, state)
+            del pending[:used]
+            scheduler.submit(client, work)
+            if delayed is None:
+                await writer.drain()
+            # the client's quota: no more queries are read while it has that many queued
+            await client.drained.wait()
+        # the client may still read the replies to the queries it sent before closing its side
+        await client.idle.wait()
+        # flush returns early once a write finds the client gone, so that its slot is always freed below
+        if delayed is not None and not writer.is_closing():
+            await delayed.flush()
+        if client.refused:
+            print(f"server: {counter.port} query budget used up: {addr}")
+        else:
+            print(f"server: {counter.port} closed: {addr}")
+    except ConnectionError:
+        print(f"server: {counter.port} connection error: {addr}")
+    finally:
+        client.close()
+        if delayed is not None:
+            delayed.close()
+        writer.close()
+
+
+async def serve(
+    port: int | str,
+    keys: KeyRing,
+    verbose: bool,
+    listener: socket.socket | None = None,
+    metrics: WorkerMetrics | None = None,
+    budget: PortBudget | None = None,
+    latency: Latency | None = None,
+    weights: dict[str, float] | None = None,
+    queue_limit: int = QUEUE_LIMIT,
+    clients: ClientTable | None = None,
+):
+    """
+    Serves every client that connects to `port`, concurrently,
+    sharing the decryptions between them fairly (see `oracle_server.scheduler`).
+
+    Args:
+        port (int | str): The port to serve, or the URL `listener` serves, see `utils.transport`.
+        keys (KeyRing): The keys the clients pick from.
+        verbose (bool): If True, prints server progress every 10000 messages.
+        listener (socket.socket | None, optional): An already listening TCP or Unix domain socket on `port`.
+            Defaults to None.
+        metrics (WorkerMetrics | None, optional): Counts the connections. Defaults to None.
+        budget (PortBudget | None, optional): The queries the port may answer. Defaults to None, for no limit.
+        latency (Latency | None, optional): Delays the replies. Defaults to None, for no injected latency.
+        weights (dict[str, float] | None, optional): The share of the decryptions of the clients on every host.
+            Defaults to None, which weighs every client 1.
+        queue_limit (int, optional): The queries a client may have queued. Defaults to QUEUE_LIMIT.
+        clients (ClientTable | None, optional): Where the clients and their queue depths are reported.
+            Defaults to None.
+    """
+    counter = QueryCounter(port, verbose)
+    scheduler = FairScheduler(budget, counter.add, queue_limit=queue_limit)
+
+    def on_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        return serve_client(
+            reader, writer, keys, counter, scheduler, metrics, latency, weights, clients
+        )
+
+    if listener is not None:
+        server = await asyncio.start_server(on_client, sock=listener)
+    else:
+        server = await asyncio.start_server(on_client, port=port, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
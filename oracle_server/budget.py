@@ -0,0 +1,120 @@
+"""
+Query budgets, which stop the servers after a number of answered queries instead of after a timeout.
+
+Wall-clock timeouts make a run depend on the machine's load, while a query budget makes two runs
+of the same attack end at the same point, so attack strategies are compared by their queries.
+A budget is given either to every port, or to the whole fleet. Its counters live in shared memory
+and every query is taken out of it under a lock, so the worker processes together never answer
+more queries than the budget. A server whose budget is used up closes its clients' connections,
+and `main` stops the fleet once every budget is used up, and prints how each one was consumed.
+"""
+
+from multiprocessing.sharedctypes import RawArray, RawValue
+from time import monotonic, sleep
+import multiprocessing
+
+POLL_INTERVAL = 0.1  # seconds between two checks whether the budgets are used up
+
+
+class QueryBudget:
+    """
+    A number of queries shared by the workers of one or more ports.
+    Create it before forking the workers, and give the workers of every port its `PortBudget`.
+    """
+
+    def __init__(self, limit: int, ports: list[int | str]) -> None:
+        """
+        Args:
+            limit (int): The number of queries the ports answer together.
+            ports (list[int | str]): The ports (or URLs) sharing the budget.
+        """
+        self.limit = limit
+        self.ports = ports
+        self.lock = multiprocessing.get_context("fork").Lock()
+        self.used = RawValue("Q", 0)
+        self.answered = RawArray("Q", len(ports))
+        self.refused = RawArray("Q", len(ports))
+        self.started = RawValue("d", 0.0)
+        self.finished = RawValue("d", 0.0)
+
+    def port(self, slot: int) -> "PortBudget":
+        return PortBudget(self, slot)
+
+    def take(self, slot: int, count: int) -> bool:
+        """
+        Takes `count` queries of the port at index `slot` out of the budget.
+
+        Returns:
+            bool: False if fewer than `count` queries are left, in which case none are taken
+                and the budget is used up.
+        """
+        with self.lock:
+            if self.used.value + count > self.limit:
+                self.refused[slot] += count
+                if not self.finished.value:
+                    self.finished.value = monotonic()
+                return False
+            if not self.started.value:
+                self.started.value = monotonic()
+            self.used.value += count
+            self.answered[slot] += count
+            if self.used.value == self.limit:
+                self.finished.value = monotonic()
+            return True
+
+    @property
+    def exhausted(self) -> bool:
+        return self.finished.value != 0
+
+    def report(self) -> str:
+        """
+        Returns how the budget was consumed: the queries answered and refused on every port,
+        and how long it took from the first query until the budget was used up.
+        """
+        used = self.used.value
+        if not used:
+            elapsed = 0.0
+        else:
+            end = self.finished.value if self.exhausted else monotonic()
+            elapsed = end - self.started.value
+        rate = f" ({used / elapsed:.0f} queries/s)" if elapsed else ""
+        state = "used up" if self.exhausted else "not used up"
+        name = self.ports[0] if len(self.ports) == 1 else "the fleet"
+        lines = [
+            f"query budget of {name} {state}: {used} of {self.limit} queries answered"
+            f" in {elapsed:.2f}s{rate}, {sum(self.refused)} refused"
+        ]
+        if len(self.ports) > 1:
+            for slot, port in enumerate(self.ports):
+                lines.append(
+                    f"    {port}: {self.answered[slot]} answered, {self.refused[slot]} refused"
+                )
+        return "\n".join(lines)
+
+
+class PortBudget:
+    """
+    The part of a `QueryBudget` the workers of a single port take their queries from.
+    """
+
+    def __init__(self, budget: QueryBudget, slot: int) -> None:
+        self.budget = budget
+        self.slot = slot
+
+    def take(self, count: int) -> bool:
+        return self.budget.take(self.slot, count)
+
+    @property
+    def exhausted(self) -> bool:
+        return self.budget.exhausted
+
+
+def wait_for_budgets(budgets: list[QueryBudget], timeout: int | None = None) -> None:
+    """
+    Returns once every budget is used up, or after `timeout` seconds if one is given.
+    """
+    deadline = None if timeout is None else monotonic() + timeout
+    while not all(budget.exhausted for budget in budgets):
+        if deadline is not None and monotonic() >= deadline:
+            return
+        sleep(POLL_INTERVAL)
@@ -0,0 +1,185 @@
+"""
+A cache of the oracle's answers, shared by all the worker processes of the fleet.
+
+With a deterministic blinding, every player of the CTF sends the same ciphertexts to the same servers,
+so most queries were already answered for someone else, and decrypting them again is wasted work.
+
+The cache is keyed by a 128 bit BLAKE2b digest of the ciphertext, keyed with the id of the server key
+it was checked with. It lives in shared memory and is set associative: a digest maps to a set of WAYS
+entries, and a full set evicts with the CLOCK algorithm, which approximates LRU with a single
+referenced bit per entry. Every set is guarded by one of LOCK_STRIPES locks, so the workers only
+contend when they touch sets sharing a lock.
+"""
+
+from hashlib import blake2b
+from multiprocessing.sharedctypes import RawArray
+from oracle_server.metrics import PaddingChecker, WorkerMetrics
+import multiprocessing
+
+DIGEST_SIZE = 16
+WAYS = 8  # entries per set
+LOCK_STRIPES = 64
+VALID, CONFORMING, REFERENCED = 1, 2, 4  # the bits of an entry's flags byte
+HITS, MISSES, EVICTIONS = range(3)
+
+
+class ResponseCache:
+    """
+    A bounded, set associative CLOCK cache from ciphertext digests to the oracle's answers.
+    Create it before forking the workers.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        """
+        Args:
+            capacity (int): The number of answers the cache holds, rounded up to a multiple of WAYS.
+        """
+        self.sets = max(1, -(-capacity // WAYS))
+        self.capacity = self.sets * WAYS
+        self.digests = RawArray("B", self.capacity * DIGEST_SIZE)
+        self.flags = RawArray("B", self.capacity)
+        self.hands = RawArray("B", self.sets)
+        context = multiprocessing.get_context("fork")
+        self.locks = [context.Lock() for _ in range(min(LOCK_STRIPES, self.sets))]
+        # hits, misses and evictions counted per lock, under it
+        self.counters = RawArray("Q", len(self.locks) * 3)
+        self.digest_view = memoryview(self.digests).cast("B")
+
+    def find(self, first: int, digest: bytes) -> int | None:
+        for entry in range(first, first + WAYS):
+            if self.flags[entry] & VALID and (
+                self.digest_view[entry * DIGEST_SIZE : (entry + 1) * DIGEST_SIZE]
+                == digest
+            ):
+                return entry
+        return None
+
+    def get(self, digest: bytes) -> bool | None:
+        """
+        Returns the cached answer for `digest`, or None if it is not cached.
+        """
+        index = int.from_bytes(digest[:8], "little") % self.sets
+        stripe = index % len(self.locks)
+        with self.locks[stripe]:
+            entry = self.find(index * WAYS, digest)
+            if entry is None:
+                self.counters[stripe * 3 + MISSES] += 1
+                return None
+            self.flags[entry] |= REFERENCED
+            self.counters[stripe * 3 + HITS] += 1
+            return bool(self.flags[entry] & CONFORMING)
+
+    def put(self, digest: bytes, conforming: bool) -> None:
+        """
+        Caches the answer for `digest`, evicting an entry of its set if the set is full.
+        """
+        index = int.from_bytes(digest[:8], "little") % self.sets
+        stripe = index % len(self.locks)
+        first = index * WAYS
+        with self.locks[stripe]:
+            if self.find(first, digest) is not None:
+                return
+            entry = next(
+                (e for e in range(first, first + WAYS) if not self.flags[e] & VALID),
+                None,
+            )
+            if entry is None:
+                # CLOCK: clear the referenced bits until an entry which was not referenced since the last pass
+                hand = self.hands[index]
+                while self.flags[first + hand] & REFERENCED:
+                    self.flags[first + hand] &= ~REFERENCED
+                    hand = (hand + 1) % WAYS
+                entry = first + hand
+                self.hands[index] = (hand + 1) % WAYS
+                self.counters[stripe * 3 + EVICTIONS] += 1
+            self.digest_view[entry * DIGEST_SIZE : (entry + 1) * DIGEST_SIZE] = digest
+            self.flags[entry] = VALID | (CONFORMING if conforming else 0)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of hits, misses and evictions so far, and the hit rate.
+        """
+        hits = sum(self.counters[HITS::3])
+        misses = sum(self.counters[MISSES::3])
+        return {
+            "capacity": self.capacity,
+            "hits": hits,
+            "misses": misses,
+            "evictions": sum(self.counters[EVICTIONS::3]),
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        }
+
+    def report(self) -> str:
+        stats = self.stats()
+        return (
+            f"response cache: {stats['hits']} hits, {stats['misses']} misses"
+            f" (hit rate {100 * stats['hit_rate']:.1f}%), {stats['evictions']} evictions"
+            f" of {stats['capacity']} entries"
+        )
+
+
+class CachedDecryptor:
+    """
+    Answers the ciphertexts found in the shared cache from it, and checks the others with `decryptor`.
+    """
+
+    def __init__(
+        self,
+        decryptor: PaddingChecker,
+        cache: ResponseCache,
+        key_id: str,
+        metrics: WorkerMetrics | None = None,
+    ) -> None:
+        """
+        Args:
+            decryptor (PaddingChecker): Checks the padding of the ciphertexts which are not cached.
+            cache (ResponseCache): The fleet's cache.
+            key_id (str): The id of the decryptor's key, so that the keys do not share answers.
+            metrics (WorkerMetrics | None, optional): Where the answers from the cache are counted,
+                the decryptor counts the others. Defaults to None.
+        """
+        self.decryptor = decryptor
+        self.cache = cache
+        self.key = key_id.encode()
+        self.metrics = metrics
+
+    def check_padding(self, ciphertext: bytes) -> bool:
+        digest = blake2b(ciphertext, digest_size=DIGEST_SIZE, key=self.key).digest()
+        conforming = self.cache.get(digest)
+        if conforming is not None:
+            if self.metrics is not None:
+                self.metrics.record_hit(conforming)
+            return conforming
+        conforming = self.decryptor.check_padding(ciphertext)
+        self.cache.put(digest, conforming)
+        return conforming
+
+
+if __name__ == "__main__":
+    cache = ResponseCache(WAYS)  # a single set
+    digests = [bytes([i]) * DIGEST_SIZE for i in range(WAYS + 1)]
+    assert cache.get(digests[0]) is None
+    for i, digest in enumerate(digests[:WAYS]):
+        cache.put(digest, i % 2 == 0)
+    # the set is full, and every way but the last one gets referenced
+    assert [cache.get(digest) for digest in digests[: WAYS - 1]] == [
+        i % 2 == 0 for i in range(WAYS - 1)
+    ]
+    cache.put(digests[WAYS], True)
+    assert cache.get(digests[WAYS - 1]) is None
+    assert all(cache.get(digest) is not None for digest in digests[: WAYS - 1])
+    assert cache.get(digests[WAYS]) is True
+    assert cache.stats()["evictions"] == 1
+
+    class Counting:
+        def __init__(self) -> None:
+            self.checked = 0
+
+        def check_padding(self, ciphertext: bytes) -> bool:
+            self.checked += 1
+            return True
+
+    decryptor = Counting()
+    cached = CachedDecryptor(decryptor, ResponseCache(64), "default")
+    assert cached.check_padding(b"c" * 128) and cached.check_padding(b"c" * 128)
+    assert decryptor.checked == 1
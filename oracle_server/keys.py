@@ -0,0 +1,118 @@
+"""
+The keys an oracle server hosts, so that a single fleet serves every scenario (such as the CTF levels) at once.
+
+Every key has its own `CrtDecryptor`, built once before the workers are forked, and its own row of metrics.
+A client picks a key by its id with the handshake of `utils.protocol`.
+"""
+
+from Crypto.PublicKey import RSA
+from oracle_server.cache import CachedDecryptor, ResponseCache
+from oracle_server.metrics import MeteredDecryptor, PaddingChecker, WorkerMetrics
+from utils.protocol import DEFAULT_KEY, KEY_ID_SIZE, KEY_SIZE
+from utils.rsa import CrtDecryptor
+
+DEFAULT_KEY_FILE = "private_key.rsa"
+
+
+def parse_key_specs(specs: list[str]) -> dict[str, str]:
+    """
+    Returns the key file of every key id, from specs of the form ID=PATH.
+
+    Raises:
+        ValueError: If a spec is malformed, or a key id is used twice.
+    """
+    paths: dict[str, str] = {}
+    for spec in specs:
+        key_id, sep, path = spec.partition("=")
+        if not sep or not key_id or not path:
+            raise ValueError(f"expected ID=PATH, got {spec!r}")
+        if len(key_id.encode()) > KEY_ID_SIZE:
+            raise ValueError(f"a key id takes at most {KEY_ID_SIZE} bytes: {key_id!r}")
+        if key_id in paths:
+            raise ValueError(f"the key id {key_id!r} is used twice")
+        paths[key_id] = path
+    return paths
+
+
+class KeyRing:
+    """
+    The padding checkers of the keys a server hosts, by key id.
+    The first key is the default one, used by the connections which do not pick a key.
+    """
+
+    def __init__(self, checkers: dict[str, PaddingChecker]) -> None:
+        assert checkers, "a server hosts at least one key"
+        self.checkers = checkers
+
+    @classmethod
+    def load(cls, paths: dict[str, str] | None = None) -> "KeyRing":
+        """
+        Loads the private keys and builds their decryptors.
+
+        Args:
+            paths (dict[str, str] | None, optional): The key file of every key id.
+                Defaults to None, which hosts DEFAULT_KEY_FILE as DEFAULT_KEY.
+
+        Raises:
+            ValueError: If a key is not of KEY_SIZE bits, the size the messages of `utils.protocol` are framed by.
+        """
+        if not paths:
+            paths = {DEFAULT_KEY: DEFAULT_KEY_FILE}
+        checkers: dict[str, PaddingChecker] = {}
+        for key_id, path in paths.items():
+            with open(path, "rb") as key_file:
+                key = RSA.import_key(key_file.read())
+            if key.size_in_bits() != KEY_SIZE:
+                raise ValueError(
+                    f"the key {key_id!r} is of {key.size_in_bits()} bits, not {KEY_SIZE}"
+                )
+            checkers[key_id] = CrtDecryptor(key)
+        return cls(checkers)
+
+    @property
+    def ids(self) -> list[str]:
+        return list(self.checkers)
+
+    @property
+    def default(self) -> PaddingChecker:
+        return next(iter(self.checkers.values()))
+
+    def get(self, key_id: str) -> PaddingChecker | None:
+        return self.checkers.get(key_id)
+
+    def metered(self, metrics: list[WorkerMetrics]) -> "KeyRing":
+        """
+        Returns the same keys, recording every check in the metrics of its key.
+
+        Args:
+            metrics (list[WorkerMetrics]): The worker's metrics of every key, in the order of `ids`.
+        """
+        return KeyRing(
+            {
+                key_id: MeteredDecryptor(checker, key_metrics)
+                for (key_id, checker), key_metrics in zip(
+                    self.checkers.items(), metrics, strict=True
+                )
+            }
+        )
+
+    def cached(
+        self, cache: ResponseCache, metrics: list[WorkerMetrics] | None = None
+    ) -> "KeyRing":
+        """
+        Returns the same keys, answering the ciphertexts found in `cache` from it.
+
+        Args:
+            cache (ResponseCache): The fleet's response cache, shared by all the keys.
+            metrics (list[WorkerMetrics] | None, optional): The worker's metrics of every key,
+                in the order of `ids`, where the answers from the cache are counted. Defaults to None.
+        """
+        key_metrics = metrics or [None] * len(self.checkers)
+        return KeyRing(
+            {
+                key_id: CachedDecryptor(checker, cache, key_id, checker_metrics)
+                for (key_id, checker), checker_metrics in zip(
+                    self.checkers.items(), key_metrics, strict=True
+                )
+            }
+        )
@@ -0,0 +1,155 @@
+"""
+Injected network latency, to benchmark pipelining, hedging and multi-server scheduling
+against WAN-like conditions on a single machine.
+
+A latency spec is a sum of components separated by "+", each one a name and its parameters in milliseconds:
+    - fixed:MS: always MS.
+    - normal:MEAN,STD: normally distributed, never below zero.
+    - longtail:MEDIAN,SIGMA: log-normally distributed around MEDIAN, the larger SIGMA the longer the tail.
+    - stall:PROBABILITY,MS: MS with the given probability, and nothing otherwise.
+For example "normal:20,3+stall:0.001,500" is a 20ms link which stalls for half a second once in a thousand replies.
+
+The replies of a connection are delayed by `DelayedWriter`, which keeps them in order like a TCP stream does:
+a stalled reply holds up the replies after it, but never those of the other connections.
+"""
+
+from random import Random
+import asyncio
+import math
+
+DISTRIBUTIONS = {
+    "fixed": 1,
+    "normal": 2,
+    "longtail": 2,
+    "stall": 2,
+}
+
+
+class Latency:
+    """
+    A distribution of reply delays, parsed from a latency spec.
+    """
+
+    def __init__(self, spec: str, seed: int | None = None) -> None:
+        """
+        Args:
+            spec (str): The latency spec, see the module's docstring.
+            seed (int | None, optional): Seeds the delays. Defaults to None, for a random seed.
+
+        Raises:
+            ValueError: If the spec is malformed.
+        """
+        self.spec = spec
+        self.random = Random(seed)
+        self.components: list[tuple[str, list[float]]] = []
+        for component in spec.split("+"):
+            name, _, params = component.strip().partition(":")
+            if name not in DISTRIBUTIONS:
+                raise ValueError(
+                    f"unknown latency {name!r}, expected one of {list(DISTRIBUTIONS)}"
+                )
+            values = [float(value) for value in params.split(",")] if params else []
+            if len(values) != DISTRIBUTIONS[name] or any(value < 0 for value in values):
+                raise ValueError(
+                    f"{name} latency takes {DISTRIBUTIONS[name]} non-negative parameters"
+                )
+            if name == "stall" and values[0] > 1:
+                raise ValueError("the stall probability is at most 1")
+            self.components.append((name, values))
+
+    def sample_ms(self) -> float:
+        """
+        Returns a random delay in milliseconds.
+        """
+        total = 0.0
+        for name, values in self.components:
+            if name == "fixed":
+                total += values[0]
+            elif name == "normal":
+                total += max(0.0, self.random.gauss(values[0], values[1]))
+            elif name == "longtail":
+                median, sigma = values
+                if median > 0:
+                    total += self.random.lognormvariate(math.log(median), sigma)
+            elif self.random.random() < values[0]:
+                total += values[1]
+        return total
+
+    def sample(self) -> float:
+        """
+        Returns a random delay in seconds.
+        """
+        return self.sample_ms() / 1000
+
+
+def port_latencies(specs: str, count: int) -> list[Latency | None]:
+    """
+    Returns the latency of each of `count` ports, from specs separated by ";".
+    The i-th spec is for the i-th port, and the last one is for all the ports after it as well.
+    An empty spec means no injected latency.
+    """
+    parts = specs.split(";")
+    parts += [parts[-1]] * (count - len(parts))
+    return [Latency(part) if part.strip() else None for part in parts[:count]]
+
+
+class DelayedWriter:
+    """
+    Writes the replies of a connection after a random delay each, in the order they were given.
+    Every reply is delivered no earlier than the one before it, as on a single TCP stream.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, latency: Latency) -> None:
+        self.writer = writer
+        self.latency = latency
+        self.queue: asyncio.Queue[tuple[float, bytes]] = asyncio.Queue()
+        self.last_delivery = 0.0
+        # set once the client is gone, the replies are dropped from then on
+        self.closed = False
+        self.task = asyncio.ensure_future(self.deliver())
+
+    def write(self, data: bytes) -> None:
+        if self.closed:
+            return
+        loop = asyncio.get_running_loop()
+        self.last_delivery = max(
+            self.last_delivery, loop.time() + self.latency.sample()
+        )
+        self.queue.put_nowait((self.last_delivery, data))
+
+    async def deliver(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            when, data = await self.queue.get()
+            try:
+                await asyncio.sleep(max(0.0, when - loop.time()))
+                self.writer.write(data)
+                await self.writer.drain()
+            except ConnectionError:
+                self.closed = True
+                self.drop()
+                return
+            finally:
+                self.queue.task_done()
+
+    def drop(self) -> None:
+        """
+        Marks the replies which were not written yet as done, without writing them.
+        """
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            self.queue.task_done()
+
+    async def flush(self) -> None:
+        """
+        Waits until every reply was written, or dropped because the client is gone.
+        """
+        join = asyncio.ensure_future(self.queue.join())
+        await asyncio.wait([join, self.task], return_when=asyncio.FIRST_COMPLETED)
+        join.cancel()
+
+    def close(self) -> None:
+        """
+        Drops the replies which were not written yet.
+        """
+        self.task.cancel()
@@ -0,0 +1,321 @@
+"""
+Live metrics of the oracle server fleet.
+
+Every worker process owns a row of a shared memory array for every key it hosts (see `oracle_server.keys`),
+which only it writes to, so the counters need no locks. A row holds the number of queries, conforming answers, connections,
+the total decrypt time, the queries answered from the response cache (see `oracle_server.cache`),
+and a histogram of the decrypt times with power of two buckets in microseconds.
+
+`StatsServer` runs in the process that started the fleet, and serves the counters aggregated
+per port, per key and for the whole fleet as JSON over HTTP, together with the queries per second
+measured over the last SAMPLE_INTERVAL seconds, and the statistics of the response cache.
+The connections are counted before they pick a key, so they are only reported per port and for the fleet.
+
+The workers serving many clients at once also share a table of their clients (see `oracle_server.scheduler`),
+with the weight of every client, the queries it has queued and the queries it got answered.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.sharedctypes import RawArray
+from time import perf_counter_ns, monotonic, sleep
+from typing import Protocol, TYPE_CHECKING
+from utils.protocol import DEFAULT_KEY
+import json
+import threading
+
+if TYPE_CHECKING:
+    from oracle_server.cache import ResponseCache
+
+QUERIES, CONFORMING, CONNECTIONS, DECRYPT_NS, CACHE_HITS, HISTOGRAM = range(6)
+HISTOGRAM_BUCKETS = (
+    20  # the last bucket holds every decrypt time from 2^18 microseconds up
+)
+FIELDS = HISTOGRAM + HISTOGRAM_BUCKETS
+SAMPLE_INTERVAL = 1.0  # seconds between two measurements of the queries per second
+
+CLIENT_QUEUED, CLIENT_ANSWERED, CLIENT_WEIGHT = range(3)
+CLIENT_FIELDS = 3
+# the clients a worker reports at once, the ones connected after them are served but not reported
+CLIENT_SLOTS = 64
+PEER_SIZE = 64  # bytes of a client's address in the table
+
+
+class WorkerMetrics:
+    """
+    The counters of a single worker process, a view of its row in the shared array.
+    """
+
+    def __init__(self, counters, slot: int) -> None:
+        self.counters = counters
+        self.base = slot * FIELDS
+
+    def connected(self) -> None:
+        self.counters[self.base + CONNECTIONS] += 1
+
+    def record(self, conforming: bool, elapsed_ns: int) -> None:
+        base = self.base
+        self.counters[base + QUERIES] += 1
+        self.counters[base + CONFORMING] += conforming
+        self.counters[base + DECRYPT_NS] += elapsed_ns
+        bucket = min((elapsed_ns // 1000).bit_length(), HISTOGRAM_BUCKETS - 1)
+        self.counters[base + HISTOGRAM + bucket] += 1
+
+    def record_hit(self, conforming: bool) -> None:
+        """
+        Records a query answered from the response cache, which took no decryption.
+        """
+        base = self.base
+        self.counters[base + QUERIES] += 1
+        self.counters[base + CONFORMING] += conforming
+        self.counters[base + CACHE_HITS] += 1
+
+
+class ClientTable:
+    """
+    The clients of a single worker process, a view of its slots in the shared client table.
+    A slot is free while its peer is empty.
+    """
+
+    def __init__(self, counters, peers, slot: int) -> None:
+        self.counters = counters
+        self.peers = peers
+        self.first = slot * CLIENT_SLOTS
+
+    def add(self, peer: str, weight: float) -> int | None:
+        """
+        Reports a new client, and returns its index in the table, or None if the worker's slots are all taken.
+        """
+        for index in range(self.first, self.first + CLIENT_SLOTS):
+            if self.peers[index * PEER_SIZE] == b"\x00":
+                base = index * CLIENT_FIELDS
+                self.counters[base + CLIENT_QUEUED] = 0
+                self.counters[base + CLIENT_ANSWERED] = 0
+                self.counters[base + CLIENT_WEIGHT] = weight
+                # written last, the client is reported once its counters are set
+                name = peer.encode()[: PEER_SIZE - 1] or b"?"
+                self.peers[index * PEER_SIZE : (index + 1) * PEER_SIZE] = name.ljust(
+                    PEER_SIZE, b"\x00"
+                )
+                return index
+        return None
+
+    def update(self, index: int, queued: int, answered: int) -> None:
+        base = index * CLIENT_FIELDS
+        self.counters[base + CLIENT_QUEUED] = queued
+        self.counters[base + CLIENT_ANSWERED] = answered
+
+    def remove(self, index: int) -> None:
+        self.peers[index * PEER_SIZE] = b"\x00"
+
+
+class PaddingChecker(Protocol):
+    """
+    What the server loops check the padding with: a `CrtDecryptor`, or a wrapper of one.
+    """
+
+    def check_padding(self, ciphertext: bytes) -> bool: ...
+
+
+class MeteredDecryptor:
+    """
+    Checks the padding with a `CrtDecryptor`, and records every check in the worker's metrics.
+    """
+
+    def __init__(self, decryptor: PaddingChecker, metrics: WorkerMetrics) -> None:
+        self.decryptor = decryptor
+        self.metrics = metrics
+
+    def check_padding(self, ciphertext: bytes) -> bool:
+        start = perf_counter_ns()
+        conforming = self.decryptor.check_padding(ciphertext)
+        self.metrics.record(conforming, perf_counter_ns() - start)
+        return conforming
+
+
+class FleetMetrics:
+    """
+    The shared counters of all the worker processes of the fleet.
+    Create it before forking the workers, and give every worker its own slot.
+    """
+
+    def __init__(self, ports: list[int | str], keys: list[str] | None = None) -> None:
+        """
+        Args:
+            ports (list[int | str]): The port (or URL) every worker serves, the index of a worker in it is its slot.
+            keys (list[str] | None, optional): The ids of the keys every worker hosts. Defaults to None, for DEFAULT_KEY.
+        """
+        self.ports = ports
+        self.keys = keys or [DEFAULT_KEY]
+        self.counters = RawArray("Q", len(ports) * len(self.keys) * FIELDS)
+        self.client_counters = RawArray("d", len(ports) * CLIENT_SLOTS * CLIENT_FIELDS)
+        self.peers = RawArray("c", len(ports) * CLIENT_SLOTS * PEER_SIZE)
+
+    def worker(self, slot: int, key: int = 0) -> WorkerMetrics:
+        """
+        Returns the counters of the worker at `slot` for the key at index `key` of `keys`.
+        """
+        return WorkerMetrics(self.counters, slot * len(self.keys) + key)
+
+    def worker_keys(self, slot: int) -> list[WorkerMetrics]:
+        """
+        Returns the counters of the worker at `slot` for every key, in the order of `keys`.
+        """
+        return [self.worker(slot, key) for key in range(len(self.keys))]
+
+    def worker_clients(self, slot: int) -> ClientTable:
+        """
+        Returns the client table of the worker at `slot`.
+        """
+        return ClientTable(self.client_counters, self.peers, slot)
+
+    def clients(self) -> dict[int | str, list[dict]]:
+        """
+        Returns the connected clients of every port, with their weight, queue depth and answered queries.
+        """
+        clients: dict[int | str, list[dict]] = {}
+        for index in range(len(self.ports) * CLIENT_SLOTS):
+            peer = self.peers[index * PEER_SIZE : (index + 1) * PEER_SIZE]
+            if peer[0] == 0:
+                continue
+            base = index * CLIENT_FIELDS
+            clients.setdefault(self.ports[index // CLIENT_SLOTS], []).append(
+                {
+                    "peer": peer.rstrip(b"\x00").decode(errors="replace"),
+                    "weight": self.client_counters[base + CLIENT_WEIGHT],
+                    "queued": int(self.client_counters[base + CLIENT_QUEUED]),
+                    "answered": int(self.client_counters[base + CLIENT_ANSWERED]),
+                }
+            )
+        return clients
+
+    def snapshot(self, by_key: bool = False) -> dict[int | str, list[int]]:
+        """
+        Returns the counters summed over the workers of every port, or over all the workers for every key.
+        """
+        totals: dict[int | str, list[int]] = {}
+        for row_index in range(len(self.ports) * len(self.keys)):
+            slot, key = divmod(row_index, len(self.keys))
+            label = self.keys[key] if by_key else self.ports[slot]
+            row = self.counters[row_index * FIELDS : (row_index + 1) * FIELDS]
+            total = totals.setdefault(label, [0] * FIELDS)
+            for i, value in enumerate(row):
+                total[i] += value
+        return totals
+
+
+def histogram(row: list[int]) -> dict[str, int]:
+    """
+    Returns the decrypt time histogram of a row of counters, labeled by the bucket's range in microseconds.
+    """
+    labels = ["<1"] + [
+        f"{1 << (i - 1)}-{1 << i}" for i in range(1, HISTOGRAM_BUCKETS - 1)
+    ]
+    labels.append(f">={1 << (HISTOGRAM_BUCKETS - 2)}")
+    return {
+        label: count
+        for label, count in zip(labels, row[HISTOGRAM:], strict=True)
+        if count
+    }
+
+
+def summarize(row: list[int], qps: float, connections: bool = True) -> dict:
+    """
+    Returns the statistics of a row of counters. Without `connections`, the connections are left out,
+    as for the keys: every connection is counted on the default key's row, before it picks a key.
+    """
+    queries = row[QUERIES]
+    decrypted = queries - row[CACHE_HITS]
+    return {
+        "queries": queries,
+        "conforming": row[CONFORMING],
+        **({"connections": row[CONNECTIONS]} if connections else {}),
+        "qps": round(qps, 1),
+        "cache_hits": row[CACHE_HITS],
+        "cache_hit_rate": round(row[CACHE_HITS] / queries, 4) if queries else 0.0,
+        "avg_decrypt_us": (
+            round(row[DECRYPT_NS] / decrypted / 1000, 1) if decrypted else 0
+        ),
+        "decrypt_us_histogram": histogram(row),
+    }
+
+
+def rates(
+    previous: dict[int | str, list[int]],
+    current: dict[int | str, list[int]],
+    elapsed: float,
+) -> dict[int | str, float]:
+    """
+    Returns the queries per second of every label between two snapshots taken `elapsed` seconds apart.
+    """
+    return {
+        label: (row[QUERIES] - previous[label][QUERIES]) / elapsed
+        for label, row in current.items()
+    }
+
+
+class StatsServer:
+    """
+    Serves the fleet's metrics as JSON on http://localhost:<port>/ from a background thread.
+    """
+
+    def __init__(
+        self, metrics: FleetMetrics, port: int, cache: "ResponseCache | None" = None
+    ) -> None:
+        self.metrics = metrics
+        self.cache = cache
+        self.rates: dict[int | str, float] = {}
+        self.key_rates: dict[int | str, float] = {}
+        stats = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(stats.report(), indent=2).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http = ThreadingHTTPServer(("localhost", port), Handler)
+
+    def sample_rates(self) -> None:
+        """
+        Measures the queries per second of every port and every key, every SAMPLE_INTERVAL seconds.
+        """
+        previous, previous_time = self.metrics.snapshot(), monotonic()
+        previous_keys = self.metrics.snapshot(by_key=True)
+        while True:
+            sleep(SAMPLE_INTERVAL)
+            current, now = self.metrics.snapshot(), monotonic()
+            current_keys = self.metrics.snapshot(by_key=True)
+            self.rates = rates(previous, current, now - previous_time)
+            self.key_rates = rates(previous_keys, current_keys, now - previous_time)
+            previous, previous_keys, previous_time = current, current_keys, now
+
+    def report(self) -> dict:
+        snapshot = self.metrics.snapshot()
+        fleet = [sum(values) for values in zip(*snapshot.values())]
+        report = {
+            "ports": {
+                port: summarize(row, self.rates.get(port, 0.0))
+                for port, row in snapshot.items()
+            },
+            "fleet": summarize(fleet, sum(self.rates.values())),
+        }
+        if len(self.metrics.keys) > 1:
+            report["keys"] = {
+                key: summarize(row, self.key_rates.get(key, 0.0), connections=False)
+                for key, row in self.metrics.snapshot(by_key=True).items()
+            }
+        if self.cache is not None:
+            report["cache"] = self.cache.stats()
+        if clients := self.metrics.clients():
+            report["clients"] = clients
+        return report
+
+    def start(self) -> None:
+        threading.Thread(target=self.sample_rates, daemon=True).start()
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
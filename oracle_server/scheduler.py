@@ -0,0 +1,273 @@
+"""
+Fair queuing of the decryptions between the clients of a port, for the servers serving many clients at once.
+
+Without it, a client which pipelines deep windows or sends large batch frames gets all its queries decrypted
+before the next client's turn, and the clients querying one at a time wait behind it. Instead, every client
+queues its queries, and `FairScheduler` decrypts them by deficit round robin: every round, a client is granted
+QUANTUM queries times its weight, and the queries it was granted but could not use yet are kept for the next round.
+A batch frame is decrypted over as many rounds as it takes, and answered once it is complete. So the clients
+get the decryptions in the ratio of their weights, whatever their queue depths, and the port never idles
+while a query is queued.
+
+A client also has a quota: the server stops reading its queries while it has that many queued,
+so that a client which floods the port holds up its own connection and not the server's memory.
+"""
+
+from collections import deque
+from dataclasses import dataclass, field
+from oracle_server.budget import PortBudget
+from oracle_server.metrics import ClientTable, PaddingChecker
+from typing import Callable
+from utils.protocol import encode_bitmap
+import asyncio
+
+QUANTUM = 16  # queries a client of weight 1 gets decrypted per round
+# queries a client may have queued before its queries are no longer read
+QUEUE_LIMIT = 4096
+# event loop iterations between two turns: a query which arrived during a turn is received by a callback,
+# which wakes up the client's coroutine, which queues it, so that it is queued before the next turn
+TURN_YIELDS = 3
+
+
+def parse_weights(specs: str) -> dict[str, float]:
+    """
+    Returns the weight of every client host, from specs of the form HOST=WEIGHT separated by ",".
+
+    Raises:
+        ValueError: If a spec is malformed, or a weight is not positive.
+    """
+    weights: dict[str, float] = {}
+    for spec in specs.split(","):
+        host, sep, weight = spec.strip().partition("=")
+        if not sep or not host:
+            raise ValueError(f"expected HOST=WEIGHT, got {spec!r}")
+        weights[host] = float(weight)
+        if not weights[host] > 0:
+            raise ValueError(f"the weight of {host} is not positive")
+    return weights
+
+
+@dataclass
+class Work:
+    """
+    Queued work of a client: a query, a batch frame, or the reply to a handshake, which takes no decryption.
+    """
+
+    decryptor: PaddingChecker | None
+    ciphertexts: list[bytes] = field(default_factory=list)
+    batch: bool = False
+    reply: bytes = b""
+    answers: list[bool] = field(default_factory=list)
+
+    def answer(self) -> bytes:
+        if self.decryptor is None:
+            return self.reply
+        if self.batch:
+            return encode_bitmap(self.answers)
+        return bytes(self.answers)
+
+
+class ClientQueue:
+    """
+    The queued work of a client, and its share of the decryptions.
+    """
+
+    def __init__(
+        self,
+        peer: str,
+        weight: float,
+        send: Callable[[bytes], None],
+        table: ClientTable | None = None,
+        on_refused: Callable[[], None] | None = None,
+    ) -> None:
+        """
+        Args:
+            peer (str): The client's address.
+            weight (float): The client's share of the decryptions, relative to the other clients'.
+            send (Callable[[bytes], None]): Writes replies to the client.
+            table (ClientTable | None, optional): Where the client's queue depth is reported. Defaults to None.
+            on_refused (Callable[[], None] | None, optional): Called once the budget refuses the client's queries,
+                to stop reading them. Defaults to None.
+        """
+        self.peer = peer
+        self.weight = weight
+        self.send = send
+        self.work: deque[Work] = deque()
+        self.deficit = 0.0
+        self.queued = 0
+        self.answered = 0
+        self.scheduled = False
+        self.refused = False
+        self.on_refused = on_refused
+        # set while fewer queries than the quota are queued
+        self.drained = asyncio.Event()
+        self.drained.set()
+        # set while nothing is queued
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.table = table
+        self.index = table.add(peer, weight) if table is not None else None
+
+    def report(self) -> None:
+        if self.index is not None:
+            self.table.update(self.index, self.queued, self.answered)
+
+    def close(self) -> None:
+        self.work.clear()
+        if self.index is not None:
+            self.table.remove(self.index)
+            self.index = None
+
+
+class FairScheduler:
+    """
+    Decrypts the queued queries of the clients of a port by deficit round robin, in a task of its own.
+    """
+
+    def __init__(
+        self,
+        budget: PortBudget | None = None,
+        on_answered: Callable[[int], None] | None = None,
+        quantum: int = QUANTUM,
+        queue_limit: int = QUEUE_LIMIT,
+    ) -> None:
+        """
+        Args:
+            budget (PortBudget | None, optional): The queries the port may answer. Defaults to None, for no limit.
+            on_answered (Callable[[int], None] | None, optional): Called with the number of queries
+                answered at every turn. Defaults to None.
+            quantum (int, optional): The queries a client of weight 1 gets decrypted per round. Defaults to QUANTUM.
+            queue_limit (int, optional): The queries a client may have queued. Defaults to QUEUE_LIMIT.
+
+        Raises:
+            ValueError: If `queue_limit` is less than 1, which would never let a client's queries be read again.
+        """
+        if queue_limit < 1:
+            raise ValueError(f"the queue limit is at least 1, got {queue_limit}")
+        self.budget = budget
+        self.on_answered = on_answered
+        self.quantum = quantum
+        self.queue_limit = queue_limit
+        self.active: deque[ClientQueue] = deque()
+        self.ready = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def submit(self, client: ClientQueue, work: list[Work]) -> None:
+        """
+        Queues a client's work, in the order it is to be answered.
+        """
+        if not work or client.refused:
+            return
+        client.work.extend(work)
+        client.idle.clear()
+        client.queued += sum(len(item.ciphertexts) for item in work)
+        if client.queued >= self.queue_limit:
+            client.drained.clear()
+        client.report()
+        if not client.scheduled:
+            client.scheduled = True
+            self.active.append(client)
+            self.ready.set()
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        while True:
+            if not self.active:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            client = self.active.popleft()
+            client.deficit += self.quantum * client.weight
+            self.serve(client)
+            if client.work:
+                self.active.append(client)
+            else:
+                # an idle client does not save up decryptions for later
+                client.deficit = 0.0
+                client.scheduled = False
+            for _ in range(TURN_YIELDS):
+                await asyncio.sleep(0)
+
+    def refuse(self, client: ClientQueue) -> None:
+        client.work.clear()
+        client.refused = True
+        if client.on_refused is not None:
+            client.on_refused()
+
+    def serve(self, client: ClientQueue) -> None:
+        """
+        Decrypts as many of the client's queued queries as its deficit allows, and sends the replies completed.
+        """
+        replies = bytearray()
+        decrypted = answered = 0
+        while client.work:
+            work = client.work[0]
+            if work.decryptor is not None:
+                if self.budget is not None and self.budget.exhausted:
+                    self.refuse(client)
+                    break
+                while client.deficit >= 1 and len(work.answers) < len(work.ciphertexts):
+                    work.answers.append(
+                        work.decryptor.check_padding(
+                            work.ciphertexts[len(work.answers)]
+                        )
+                    )
+                    client.deficit -= 1
+                    decrypted += 1
+                if len(work.answers) < len(work.ciphertexts):
+                    break
+                # taken once complete, so that the fleet is not stopped while the last reply is decrypted
+                if self.budget is not None and not self.budget.take(len(work.answers)):
+                    self.refuse(client)
+                    break
+                answered += len(work.answers)
+            replies += work.answer()
+            client.work.popleft()
+        client.queued = 0 if client.refused else client.queued - decrypted
+        client.answered += answered
+        if client.queued < self.queue_limit:
+            client.drained.set()
+        if not client.work:
+            client.idle.set()
+        client.report()
+        if replies:
+            client.send(bytes(replies))
+        if answered and self.on_answered is not None:
+            self.on_answered(answered)
+
+
+if __name__ == "__main__":
+
+    class Counting:
+        def __init__(self) -> None:
+            self.checked = 0
+
+        def check_padding(self, ciphertext: bytes) -> bool:
+            self.checked += 1
+            return True
+
+    async def check() -> None:
+        scheduler = FairScheduler(quantum=4, queue_limit=100)
+        replies = bytearray()
+        light, heavy = Counting(), Counting()
+        light_client = ClientQueue("light", 1.0, replies.extend)
+        heavy_client = ClientQueue("heavy", 3.0, replies.extend)
+        scheduler.submit(light_client, [Work(light, [b"l"]) for _ in range(1000)])
+        scheduler.submit(heavy_client, [Work(heavy, [b"h"] * 10) for _ in range(300)])
+        # over quota: no more of their queries would be read
+        assert not light_client.drained.is_set() and not heavy_client.drained.is_set()
+        while light.checked < 400:
+            await asyncio.sleep(0)
+        # both are backlogged, so they get 1:3 of the decryptions, give or take a round
+        assert abs(heavy.checked - 3 * light.checked) <= 3 * scheduler.quantum
+        while light_client.queued >= scheduler.queue_limit:
+            await asyncio.sleep(0)
+        assert light_client.drained.is_set()
+        while light_client.work or heavy_client.work:
+            await asyncio.sleep(0)
+        assert light_client.idle.is_set() and heavy_client.idle.is_set()
+        assert len(replies) == light.checked + heavy.checked == 1000 + 3000
+        scheduler.task.cancel()
+
+    asyncio.run(check())
@@ -1,19 +1,42 @@
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_v1_5
 from utils.connection import Connection
+from oracle_server.async_server import serve
+from oracle_server.budget import PortBudget, QueryBudget, wait_for_budgets
+from oracle_server.cache import ResponseCache
+from oracle_server.keys import KeyRing, parse_key_specs
+from oracle_server.latency import Latency, port_latencies
+from oracle_server.scheduler import QUEUE_LIMIT, parse_weights
+from oracle_server.metrics import (
+    ClientTable,
+    FleetMetrics,
+    PaddingChecker,
+    StatsServer,
+    WorkerMetrics,
+)
 import socket
 from Crypto.Util.number import bytes_to_long, getPrime, isPrime
-from utils.rsa import check_padding
+from utils.transport import ShmListener, listen, parse_url, server_urls
+from utils.protocol import (
+    KEY_SIZE,
+    CIPHERTEXT_SIZE,
+    BATCH_HELLO,
+    BATCH_ACK,
+    COUNT_SIZE,
+    MAX_BATCH,
+    KEY_ACK,
+    KEY_UNKNOWN,
+    encode_bitmap,
+    parse_key_hello,
+)
+from typing import Iterator
 import argparse
+import asyncio
 import multiprocessing
 from time import sleep
 import os
 import signal
 
 
-KEY_SIZE = 1024
-
-
 def server_arguments_parser() -> argparse.Namespace:
     """
     Parses command-line arguments for the server.
@@ -43,6 +66,65 @@ def server_arguments_parser() -> argparse.Namespace:
     parser.add_argument(
         "-p", "--port", help="sets the server's base port, defaults to 8001"
     )
+    parser.add_argument(
+        "-m",
+        "--multi-client",
+        action="store_true",
+        help="serve many clients on every port at once instead of one after the other",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        help="number of processes sharing every port, defaults to 1",
+    )
+    parser.add_argument(
+        "-s",
+        "--stats",
+        help="serves live metrics of all the servers as JSON on http://localhost:<STATS>/",
+    )
+    parser.add_argument(
+        "-u",
+        "--url",
+        help="serve on this URL instead of the base port: tcp://host:port, unix://path or shm://path",
+    )
+    parser.add_argument(
+        "-b",
+        "--budget",
+        help="stops every server after it answers this many queries, and reports how they were used",
+    )
+    parser.add_argument(
+        "--shared-budget",
+        action="store_true",
+        help="the budget is for all the servers together instead of for each of them",
+    )
+    parser.add_argument(
+        "-l",
+        "--latency",
+        help="delays the replies (implies -m): fixed:MS, normal:MEAN,STD, longtail:MEDIAN,SIGMA"
+        " or stall:PROBABILITY,MS, summed with +; separate the specs of the ports with ;"
+        " (the last spec is also for the ports after it)",
+    )
+    parser.add_argument(
+        "-K",
+        "--key",
+        action="append",
+        help="hosts the private key in PATH under the id ID (ID=PATH), may be given many times;"
+        " the first key is used by the clients which do not pick one, defaults to private_key.rsa",
+    )
+    parser.add_argument(
+        "-C",
+        "--cache",
+        help="answers repeated ciphertexts from a cache of this many answers, shared by all the workers",
+    )
+    parser.add_argument(
+        "--weights",
+        help="shares the decryptions between the clients in the ratio of their weights (implies -m):"
+        " HOST=WEIGHT separated by commas, the other hosts weigh 1",
+    )
+    parser.add_argument(
+        "--queue-limit",
+        help=f"stops reading a client's queries while it has this many queued (with -m), defaults to {QUEUE_LIMIT}",
+    )
     my_args = parser.parse_args()
     return my_args
 
@@ -72,8 +154,50 @@ def generate_key():
         f.write(public_data)
 
 
+def serve_batches(
+    conn: Connection, decryptor: PaddingChecker, budget: PortBudget | None = None
+) -> Iterator[int]:
+    """
+    Serves a connection that negotiated batch mode (see `utils.protocol`),
+    until the client disconnects or the budget has no room for its next batch.
+
+    Args:
+        conn (Connection): The client's connection, right after the batch mode was acknowledged.
+        decryptor (PaddingChecker): Checks the padding of the messages.
+        budget (PortBudget | None, optional): The queries the port may still answer. Defaults to None, for no limit.
+
+    Yields:
+        int: The number of ciphertexts in every batch that was answered.
+    """
+    while True:
+        header = conn.recv(COUNT_SIZE)
+        if len(header) < COUNT_SIZE:
+            return
+        count = int.from_bytes(header, "big")
+        if not 0 < count <= MAX_BATCH:
+            raise ConnectionError(f"invalid batch size {count}")
+
+        frame = conn.recv(count * CIPHERTEXT_SIZE)
+        if len(frame) < count * CIPHERTEXT_SIZE:
+            return
+        if budget is not None and not budget.take(count):
+            return
+        conn.send(
+            encode_bitmap(
+                decryptor.check_padding(frame[i : i + CIPHERTEXT_SIZE])
+                for i in range(0, len(frame), CIPHERTEXT_SIZE)
+            )
+        )
+        yield count
+
+
 def server_loop(
-    s: socket.socket, port: int, cipher_rsa: PKCS1_v1_5.PKCS115_Cipher, verbose: bool
+    s: socket.socket | ShmListener,
+    port: int | str,
+    keys: KeyRing,
+    verbose: bool,
+    metrics: WorkerMetrics | None = None,
+    budget: PortBudget | None = None,
 ):
     """
     Handles incoming client connections and processes their messages.
@@ -82,11 +206,18 @@ def server_loop(
     and sends a response back to the client. Optionally prints the server's progress
     every 10000 messages if verbosity is enabled.
 
+    A client may negotiate batch mode (see `utils.protocol`), in which case the rest of
+    its connection is served by `serve_batches`. Before that, it may pick one of the server's keys,
+    and otherwise its queries are checked with the default key. Once the budget is used up,
+    every connection is closed instead of answered.
+
     Args:
-        s (socket): The server socket used to accept client connections.
-        port (int): The port number the server is running on.
-        cipher_rsa (PKCS1_v1_5.PKCS115_Cipher): RSA cipher object used to decrypt messages.
+        s (socket | ShmListener): The server socket used to accept client connections.
+        port (int | str): The port number (or the URL) the server is running on.
+        keys (KeyRing): The keys the clients pick from.
         verbose (bool): If True, prints the server's progress every 10000 messages.
+        metrics (WorkerMetrics | None, optional): Counts the connections. Defaults to None.
+        budget (PortBudget | None, optional): The queries the port may answer. Defaults to None, for no limit.
 
     Returns:
         None
@@ -95,16 +226,41 @@ def server_loop(
 
     while True:
         sock, addr = s.accept()
+        if metrics is not None:
+            metrics.connected()
         conn = Connection.create_from_socket(sock)
+        decryptor: PaddingChecker = keys.default
         while True:
             try:
-                data = conn.recv(KEY_SIZE // 8)
-                # sleep(0.001)
-                if not data:
+                data = conn.recv(CIPHERTEXT_SIZE)
+                if len(data) < CIPHERTEXT_SIZE:
                     print(f"server: {port} closed: {addr}")
                     break
+                if data == BATCH_HELLO:
+                    conn.send(BATCH_ACK + MAX_BATCH.to_bytes(COUNT_SIZE, "big"))
+                    for count in serve_batches(conn, decryptor, budget):
+                        previous = num_of_messages
+                        num_of_messages += count
+                        if verbose and (previous // 10000 != num_of_messages // 10000):
+                            print(f"server: {port} got {num_of_messages} messages")
+                    if budget is not None and budget.exhausted:
+                        print(f"server: {port} query budget used up: {addr}")
+                    else:
+                        print(f"server: {port} closed: {addr}")
+                    break
+                if (key_id := parse_key_hello(data)) is not None:
+                    selected = keys.get(key_id)
+                    if selected is None:
+                        conn.send(KEY_UNKNOWN)
+                    else:
+                        decryptor = selected
+                        conn.send(KEY_ACK)
+                    continue
+                if budget is not None and not budget.take(1):
+                    print(f"server: {port} query budget used up: {addr}")
+                    break
                 num_of_messages += 1
-                correct_pad = check_padding(cipher_rsa, data, sentinel=None)
+                correct_pad = decryptor.check_padding(data)
                 if correct_pad:
                     conn.send(b"\x01")
                 else:
@@ -114,6 +270,7 @@ def server_loop(
             except ConnectionError:
                 print(f"server: {port} connection error: {addr}")
                 break
+        conn.close()
 
 
 def start_server(port: int, verbose: bool):
@@ -127,18 +284,94 @@ def start_server(port: int, verbose: bool):
     Returns:
         None
     """
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(("", port))
+    s = listen_socket(port)
+    server_loop(s, port, KeyRing.load(), verbose)
 
-    with open("private_key.rsa", "rb") as f:
-        key = RSA.import_key(f.read())
 
-    private_key = key
-    cipher_rsa = PKCS1_v1_5.new(private_key)
+def listen_socket(
+    port: int | str, reuse_port: bool = False
+) -> socket.socket | ShmListener:
+    """
+    Returns a socket listening on `port`.
+
+    Args:
+        port (int | str): The TCP port to listen on, or the URL to serve (see `utils.transport`).
+        reuse_port (bool, optional): If True, other processes may listen on the same port as well (SO_REUSEPORT),
+            and the kernel spreads the incoming connections between them. Defaults to False.
+    """
+    url = port if isinstance(port, str) else f"tcp://:{port}"
+    return listen(url, reuse_port)
+
+
+def run_worker(
+    port: int | str,
+    listener: socket.socket | ShmListener | None,
+    keys: KeyRing,
+    verbose: bool,
+    multi_client: bool,
+    metrics: list[WorkerMetrics] | None = None,
+    budget: PortBudget | None = None,
+    latency: Latency | None = None,
+    cache: ResponseCache | None = None,
+    weights: dict[str, float] | None = None,
+    queue_limit: int = QUEUE_LIMIT,
+    clients: ClientTable | None = None,
+):
+    """
+    Serves a port in a worker process.
+
+    Args:
+        port (int | str): The port, or the URL, to serve.
+        listener (socket.socket | ShmListener | None): A listener shared with the other workers of the port,
+            or None to open one of its own with SO_REUSEPORT.
+        keys (KeyRing): The keys the clients pick from.
+        verbose (bool): If True, prints server progress every 10000 messages.
+        multi_client (bool): If True, serves many clients at once, see `oracle_server.async_server`.
+        metrics (list[WorkerMetrics] | None, optional): The worker's counters of every key
+            in the fleet's shared metrics. Defaults to None.
+        budget (PortBudget | None, optional): The queries the port may answer. Defaults to None, for no limit.
+        latency (Latency | None, optional): Delays the replies, only with `multi_client`.
+            Defaults to None, for no injected latency.
+        cache (ResponseCache | None, optional): The fleet's response cache. Defaults to None, for no cache.
+        weights (dict[str, float] | None, optional): The share of the decryptions of the clients on every host,
+            only with `multi_client`. Defaults to None, which weighs every client 1.
+        queue_limit (int, optional): The queries a client may have queued, only with `multi_client`.
+            Defaults to QUEUE_LIMIT.
+        clients (ClientTable | None, optional): The worker's table of clients in the fleet's shared metrics,
+            only with `multi_client`. Defaults to None.
 
-    s.listen()
-    server_loop(s, port, cipher_rsa, verbose)
+    Returns:
+        None
+    """
+    if latency is not None:
+        # the workers are forked with the same random state, and must not all draw the same delays
+        latency.random.seed()
+    if listener is None:
+        listener = listen_socket(port, reuse_port=True)
+    connections: WorkerMetrics | None = None
+    if metrics is not None:
+        keys = keys.metered(metrics)
+        # the connections are counted before they pick a key, on the default key's row
+        connections = metrics[0]
+    if cache is not None:
+        keys = keys.cached(cache, metrics)
+    if multi_client:
+        asyncio.run(
+            serve(
+                port,
+                keys,
+                verbose,
+                listener,
+                connections,
+                budget,
+                latency,
+                weights,
+                queue_limit,
+                clients,
+            )
+        )
+    else:
+        server_loop(listener, port, keys, verbose, connections, budget)
 
 
 def stop_servers_after_delay(server_pids: list[int | None], delay: int):
@@ -158,34 +391,156 @@ def stop_servers_after_delay(server_pids: list[int | None], delay: int):
         os.kill(pid, signal.SIGTERM)
 
 
-def main(count: int, timeout: int, base_port: int):
+def main(
+    count: int,
+    timeout: int | None,
+    base_port: int,
+    multi_client: bool = False,
+    workers: int = 1,
+    stats_port: int | None = None,
+    url: str | None = None,
+    budget: int | None = None,
+    shared_budget: bool = False,
+    latency: str | None = None,
+    keys: dict[str, str] | None = None,
+    cache_size: int | None = None,
+    weights: dict[str, float] | None = None,
+    queue_limit: int = QUEUE_LIMIT,
+):
     """
     Starts the specified number of servers in separate processes and stops them
     after the given timeout.
 
+    The keys are loaded once, before the worker processes are forked, so they all share
+    their precomputed values copy-on-write. Every server hosts all the keys, see `oracle_server.keys`. Every port is served by `workers` processes,
+    which listen on it with SO_REUSEPORT where the platform supports it,
+    and otherwise accept from a single listening socket they inherit.
+
+    Given a `url`, the servers listen on it instead of on the base port, over any of the transports
+    of `utils.transport`. The Unix domain socket and shared memory transports take the TCP stack
+    out of local runs, so that they measure the attack and the decryption instead.
+
+    Given a `budget`, the servers stop once they answered that many queries instead of after the timeout,
+    see `oracle_server.budget`, and how the budget was consumed is printed when they stop.
+
+    Given a `latency`, the replies are delayed as specified in `oracle_server.latency`.
+    The delays must not hold up the other connections, so the servers serve many clients at once.
+
+    Given a `cache_size`, all the servers answer the ciphertexts they already checked from a shared cache,
+    see `oracle_server.cache`, and its hit rate is printed when they stop.
+
+    The servers serving many clients at once share the decryptions fairly between their clients,
+    in the ratio of the `weights` of the clients' hosts, see `oracle_server.scheduler`.
+
     Args:
-        count (int): The number of server processes to start.
-        timeout (int): The number of seconds before stopping the servers.
+        count (int): The number of ports to serve.
+        timeout (int | None): The number of seconds before stopping the servers.
+            None runs them until the budget is used up.
         base_port (int): The base port to start the servers on.
+        multi_client (bool, optional): If True, every server serves many clients at once,
+            see `oracle_server.async_server`. Defaults to False.
+        workers (int, optional): The number of processes serving every port. Defaults to 1.
+        stats_port (int | None, optional): Serves the fleet's metrics on this port, see `oracle_server.metrics`.
+            Defaults to None, which disables the metrics.
+        url (str | None, optional): The URL of the first server, the others follow it (see `utils.transport.server_urls`).
+            Defaults to None, which serves TCP on the base port and the ports after it.
+        budget (int | None, optional): The number of queries every port answers before it stops.
+            Defaults to None, for no limit.
+        shared_budget (bool, optional): If True, `budget` is the number of queries all the ports answer together.
+            Defaults to False.
+        latency (str | None, optional): The latency specs of the ports, see `oracle_server.latency.port_latencies`.
+            Defaults to None, for no injected latency.
+        keys (dict[str, str] | None, optional): The private key file of every key id, the first key is the default one.
+            Defaults to None, which hosts private_key.rsa.
+        cache_size (int | None, optional): The number of answers the response cache holds.
+            Defaults to None, which disables the cache.
+        weights (dict[str, float] | None, optional): The weight of the clients of every host (implies `multi_client`).
+            Defaults to None, which weighs every client 1.
+        queue_limit (int, optional): The queries a client may have queued before its queries are no longer read.
+            Defaults to QUEUE_LIMIT.
 
     Returns:
         None
     """
-    with multiprocessing.Pool(count) as pool:
-        server_pids = []
+    if queue_limit < 1:
+        raise ValueError(f"the queue limit is at least 1, got {queue_limit}")
+    key_ring = KeyRing.load(keys)
+    context = multiprocessing.get_context("fork")
+    ports: list[int | str] = [base_port + i for i in range(count)]
+    reuse_port = workers > 1 and hasattr(socket, "SO_REUSEPORT")
+    if url is not None:
+        ports = server_urls(url, count)
+        reuse_port = reuse_port and parse_url(url)[0] == "tcp"
+        if (multi_client or latency or weights) and parse_url(url)[0] == "shm":
+            raise ValueError(
+                "shared memory connections are served one client at a time"
+            )
 
-        for port in [base_port + i for i in range(count)]:
-            result = pool.apply_async(
-                start_server,
+    latencies: list[Latency | None] = [None] * count
+    if latency:
+        latencies = port_latencies(latency, count)
+        multi_client = True
+    if weights:
+        multi_client = True
+
+    cache = ResponseCache(cache_size) if cache_size else None
+
+    fleet: FleetMetrics | None = None
+    if stats_port is not None:
+        fleet = FleetMetrics(
+            [port for port in ports for _ in range(workers)], key_ring.ids
+        )
+        StatsServer(fleet, stats_port, cache).start()
+
+    budgets: list[QueryBudget] = []
+    if budget is not None:
+        if shared_budget:
+            budgets = [QueryBudget(budget, ports)]
+        else:
+            budgets = [QueryBudget(budget, [port]) for port in ports]
+
+    servers = []
+    for index, port in enumerate(ports):
+        port_budget: PortBudget | None = None
+        if shared_budget and budgets:
+            port_budget = budgets[0].port(index)
+        elif budgets:
+            port_budget = budgets[index].port(0)
+        listener = None if reuse_port else listen_socket(port)
+        for _ in range(workers):
+            metrics = fleet.worker_keys(len(servers)) if fleet is not None else None
+            clients = fleet.worker_clients(len(servers)) if fleet is not None else None
+            server = context.Process(
+                target=run_worker,
                 args=(
                     port,
+                    listener,
+                    key_ring,
                     my_args.verbose,
+                    multi_client,
+                    metrics,
+                    port_budget,
+                    latencies[index],
+                    cache,
+                    weights,
+                    queue_limit,
+                    clients,
                 ),
+                daemon=True,
             )
+            server.start()
+            servers.append(server)
 
-        servers = multiprocessing.active_children()
-        server_pids = [server.pid for server in servers]
+    server_pids = [server.pid for server in servers]
+    if not budgets:
         stop_servers_after_delay(server_pids, timeout)
+    else:
+        wait_for_budgets(budgets, timeout)
+        stop_servers_after_delay(server_pids, 0)
+        for query_budget in budgets:
+            print(query_budget.report())
+    if cache is not None:
+        print(cache.report())
 
 
 if __name__ == "__main__":
@@ -199,7 +554,12 @@ if __name__ == "__main__":
     if my_args.count and my_args.count.isdecimal():
         count = int(my_args.count)
 
-    timeout: int = 30
+    budget: int | None = None
+    if my_args.budget and my_args.budget.isdecimal():
+        budget = int(my_args.budget)
+
+    # with a budget, the servers run until it is used up unless a timeout is given
+    timeout: int | None = 30 if budget is None else None
     if my_args.timeout and my_args.timeout.isdecimal():
         timeout = int(my_args.timeout)
 
@@ -207,4 +567,35 @@ if __name__ == "__main__":
     if my_args.port and my_args.port.isdecimal():
         base_port = int(my_args.port)
 
-    main(count, timeout, base_port)
+    workers: int = 1
+    if my_args.workers and my_args.workers.isdecimal():
+        workers = int(my_args.workers)
+
+    stats_port: int | None = None
+    if my_args.stats and my_args.stats.isdecimal():
+        stats_port = int(my_args.stats)
+
+    cache_size: int | None = None
+    if my_args.cache and my_args.cache.isdecimal():
+        cache_size = int(my_args.cache)
+
+    queue_limit: int = QUEUE_LIMIT
+    if my_args.queue_limit and my_args.queue_limit.isdecimal():
+        queue_limit = int(my_args.queue_limit)
+
+    main(
+        count,
+        timeout,
+        base_port,
+        my_args.multi_client,
+        workers,
+        stats_port,
+        my_args.url,
+        budget,
+        my_args.shared_budget,
+        my_args.latency,
+        parse_key_specs(my_args.key) if my_args.key else None,
+        cache_size,
+        parse_weights(my_args.weights) if my_args.weights else None,
+        queue_limit,
+    )
@@ -4,6 +4,13 @@ from Crypto.Util.number import long_to_bytes
 from utils.rsa import check_padding_private_key
 
 
+def ceil_div(x: int, y: int) -> int:
+    """
+    Returns the ceiling of x / y, computed on integers so that it stays exact for 1024 bit numbers.
+    """
+    return (x + y - 1) // y
+
+
 def s_oracle(C: int, s: int, key: RsaKey) -> bool:
     ct = C * pow(s, key.e, key.n) % key.n
     return check_padding_private_key(long_to_bytes(ct), key)
@@ -10,7 +10,9 @@ class Connection:
 
     @classmethod
     def create_from_socket(cls, sock: socket) -> "Connection":
-        ans = Connection(*sock.getpeername())
+        peer = sock.getpeername()
+        # Unix domain sockets have a path (usually empty) instead of a host and port
+        ans = Connection(*peer) if isinstance(peer, tuple) else Connection(peer, 0)
         ans.conn = sock
         return ans
 
@@ -19,9 +21,13 @@ class Connection:
         self.conn.sendall(data)
 
     def recv(self, size: int) -> bytes:
+        """recv exactly `size` bytes, or less if the other side closed the socket"""
         ans = b""
         while len(ans) < size:
-            ans += self.conn.recv(size - len(ans))
+            data = self.conn.recv(size - len(ans))
+            if not data:
+                break
+            ans += data
 
         return ans
 
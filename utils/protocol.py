@@ -0,0 +1,85 @@
+"""
+The wire format spoken between the oracle server and the attack clients.
+
+By default every query is a single ciphertext of CIPHERTEXT_SIZE bytes, answered by a single
+byte (b"\\x01" if the padding is correct, b"\\x00" otherwise).
+
+A client may switch its connection to batch mode by sending BATCH_HELLO in place of a ciphertext.
+BATCH_HELLO is larger than any modulus of KEY_SIZE bits, so it can never be a real query.
+The server answers with BATCH_ACK followed by the maximal batch size as a 4 bytes big endian integer.
+From then on every frame is a 4 bytes big endian count followed by `count` ciphertexts,
+and the reply is a bitmap of `count` bits, most significant bit first.
+
+A server may host several keys. Before batch mode, a client may pick the key its queries are
+decrypted with by sending `key_hello(key_id)` in place of a ciphertext: KEY_HELLO_PREFIX followed by
+the key id, padded with zeros to KEY_ID_SIZE bytes. The server answers with KEY_ACK, or with KEY_UNKNOWN
+if it does not host the key, in which case the connection keeps its key. Connections which never pick
+a key use the server's default one.
+"""
+
+from typing import Iterable
+
+KEY_SIZE = 1024
+CIPHERTEXT_SIZE = KEY_SIZE // 8
+
+BATCH_HELLO = (b"\xff" * 8 + b"BATCH/1").ljust(CIPHERTEXT_SIZE, b"\xff")
+BATCH_ACK = b"\x02"
+COUNT_SIZE = 4
+MAX_BATCH = 1 << 16
+
+KEY_ID_SIZE = 32
+KEY_HELLO_PREFIX = (b"\xff" * 8 + b"KEY/1").ljust(
+    CIPHERTEXT_SIZE - KEY_ID_SIZE, b"\xff"
+)
+KEY_ACK = b"\x03"
+KEY_UNKNOWN = b"\x04"
+DEFAULT_KEY = "default"
+
+
+def key_hello(key_id: str) -> bytes:
+    """
+    Returns the message which picks the key `key_id` for the rest of the connection.
+
+    Raises:
+        ValueError: If the key id is longer than KEY_ID_SIZE bytes.
+    """
+    encoded = key_id.encode()
+    if not 0 < len(encoded) <= KEY_ID_SIZE:
+        raise ValueError(f"a key id takes 1 to {KEY_ID_SIZE} bytes, got {key_id!r}")
+    return KEY_HELLO_PREFIX + encoded.ljust(KEY_ID_SIZE, b"\x00")
+
+
+def parse_key_hello(data: bytes) -> str | None:
+    """
+    Returns the key id `data` picks, or None if it is not a `key_hello`.
+    """
+    if not data.startswith(KEY_HELLO_PREFIX):
+        return None
+    return data[len(KEY_HELLO_PREFIX) :].rstrip(b"\x00").decode(errors="replace")
+
+
+def bitmap_size(count: int) -> int:
+    """
+    Returns the number of bytes in the reply to a batch of `count` ciphertexts.
+    """
+    return (count + 7) // 8
+
+
+def encode_bitmap(answers: Iterable[bool]) -> bytes:
+    """
+    Packs the oracle's answers into a bitmap, most significant bit first.
+    """
+    bitmap = bytearray()
+    for i, answer in enumerate(answers):
+        if i % 8 == 0:
+            bitmap.append(0)
+        if answer:
+            bitmap[-1] |= 0x80 >> (i % 8)
+    return bytes(bitmap)
+
+
+def decode_bitmap(bitmap: bytes, count: int) -> list[bool]:
+    """
+    Unpacks the first `count` answers from a bitmap created by `encode_bitmap`.
+    """
+    return [bool(bitmap[i // 8] & (0x80 >> (i % 8))) for i in range(count)]
@@ -1,8 +1,15 @@
 import random
 from Crypto.Util.number import bytes_to_long, getPrime, isPrime
 from Crypto.PublicKey.RSA import RsaKey
+from Crypto.Math.Numbers import Integer
 from icecream import ic
 
+# gmpy2 is optional, it only makes the modular exponentiations faster
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
 
 def check_padding(self, ciphertext, sentinel, expected_pt_len=0):
     k = self._key.size_in_bytes()
@@ -23,3 +30,51 @@ def check_padding_private_key(ciphertext: bytes, private_key: RsaKey) -> bool:
     """
     deciphered = private_key._decrypt_to_bytes(bytes_to_long(ciphertext))
     return deciphered[0:2] == b"\x00\x02"
+
+
+class CrtDecryptor:
+    """
+    A fast padding check for the oracle server.
+
+    pycryptodome decrypts with RSA blinding on every decryption. This oracle is vulnerable on purpose,
+    so it skips the blinding and only decrypts with the Chinese remainder theorem, using exponents
+    precomputed once per key. The exponentiations run on gmpy2 when it is installed,
+    and on pycryptodome's native integers otherwise.
+    """
+
+    def __init__(self, private_key: RsaKey) -> None:
+        self.size = private_key.size_in_bytes()
+        self.shift = 8 * (
+            self.size - 2
+        )  # the plaintext starts with 0x00 0x02 iff m >> shift == 2
+        p, q, d = private_key.p, private_key.q, private_key.d
+        self.p = p
+        self.q = q
+        self.qinv = pow(q, -1, p)
+        self.number = gmpy2.mpz if gmpy2 is not None else Integer
+        self.dp = self.number(d % (p - 1))
+        self.dq = self.number(d % (q - 1))
+        self.p_number = self.number(p)
+        self.q_number = self.number(q)
+
+    def decrypt(self, ct: int) -> int:
+        c = self.number(ct)
+        m1 = int(pow(c, self.dp, self.p_number))
+        m2 = int(pow(c, self.dq, self.q_number))
+        return m2 + (self.qinv * (m1 - m2) % self.p) * self.q
+
+    def conforming(self, ct: int) -> bool:
+        """
+        Returns whether the decryption of `ct` starts with 0x00 0x02.
+        """
+        return self.decrypt(ct) >> self.shift == 2
+
+    def check_padding(self, ciphertext: bytes) -> bool:
+        """
+        Same as `check_padding`, for a ciphertext given as bytes.
+        """
+        if len(ciphertext) != self.size:
+            raise ValueError(
+                "Ciphertext with incorrect length (not %d bytes)" % self.size
+            )
+        return self.conforming(bytes_to_long(ciphertext))
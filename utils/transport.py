@@ -0,0 +1,340 @@
+"""
+The transports the oracle's clients and servers talk over, selected by the scheme of a URL:
+    - tcp://host:port: a TCP connection.
+    - unix:///path/to/socket: a Unix domain socket, which skips the TCP/IP stack on local runs.
+    - shm:///path/to/socket: a pair of ring buffers in shared memory. The Unix domain socket at the path
+      sets up the connection, and the queries and replies never go through the kernel.
+      A side waiting on a ring spins for a short while (when the other side may run on another CPU),
+      and then flags the ring and sleeps on the socket until the other side rings a one byte doorbell on it.
+      It is experimental: it only pays off when the two sides run on different CPUs, and on a single CPU host
+      its round trips measured about 20us, against 11us for tcp and 9us for unix. Its clients are served
+      one at a time.
+
+The connections of all the transports have the socket methods the oracle's code uses
+(sendall, recv, shutdown, close and getpeername), so the protocol is spoken the same way over all of them.
+"""
+
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Callable
+from urllib.parse import urlsplit
+import os
+import select
+import socket
+import stat
+import time
+
+SCHEMES = ("tcp", "unix", "shm")
+
+RING_SIZE = 1 << 16  # bytes of data in each direction
+RING_HEADER = 64  # head, tail, closed and waiting counters, padded to a cache line
+HEAD, TAIL, CLOSED, WAITING = range(4)
+
+# polls of a ring before sleeping, spinning only helps when the other side runs on another CPU
+SPIN_POLLS = 1000 if (os.cpu_count() or 1) > 1 else 0
+# polls with the CPU yielded in between, before sleeping
+YIELD_POLLS = 10
+# the longest sleep between two polls, in case a doorbell crossed the waiting flag
+DOORBELL_TIMEOUT = 0.001
+# seconds a shm client has to map the segment, the other clients wait for it meanwhile
+HANDSHAKE_TIMEOUT = 1.0
+
+
+def parse_url(url: str) -> tuple[str, str | tuple[str, int]]:
+    """
+    Splits an oracle URL into its scheme and its address.
+
+    Returns:
+        tuple[str, str | tuple[str, int]]: The scheme, and a (host, port) pair for TCP
+            or the path of the socket otherwise.
+
+    Raises:
+        ValueError: If the scheme is not one of SCHEMES, or a TCP URL has no port.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in SCHEMES:
+        raise ValueError(f"unsupported oracle URL {url}, expected one of {SCHEMES}")
+    if parts.scheme == "tcp":
+        if parts.port is None:
+            raise ValueError(f"no port in {url}")
+        return parts.scheme, (parts.hostname or "", parts.port)
+    return parts.scheme, parts.netloc + parts.path
+
+
+def server_urls(url: str, count: int) -> list[str]:
+    """
+    Returns the URLs of `count` servers starting at `url`:
+    consecutive ports for TCP, and the path followed by .1, .2, ... otherwise.
+    """
+    scheme, address = parse_url(url)
+    if scheme == "tcp":
+        host, port = address
+        return [f"tcp://{host}:{port + i}" for i in range(count)]
+    return [url] + [f"{url}.{i}" for i in range(1, count)]
+
+
+class ShmRing:
+    """
+    A single producer, single consumer byte ring in shared memory.
+
+    The head and the tail only grow. The writer only moves the tail and the reader only moves the head,
+    and the data is copied in before the tail is moved past it, so the two sides need no lock.
+    """
+
+    def __init__(self, buf: memoryview) -> None:
+        self.meta = buf[:RING_HEADER].cast("Q")
+        self.data = buf[RING_HEADER:]
+        self.size = len(self.data)
+
+    def available(self) -> int:
+        return self.meta[TAIL] - self.meta[HEAD]
+
+    def free(self) -> int:
+        return self.size - self.available()
+
+    @property
+    def closed(self) -> bool:
+        return self.meta[CLOSED] != 0
+
+    def close(self) -> None:
+        self.meta[CLOSED] = 1
+
+    @property
+    def waiting(self) -> bool:
+        """
+        Whether the other side sleeps until this ring changes.
+        """
+        return self.meta[WAITING] != 0
+
+    @waiting.setter
+    def waiting(self, value: bool) -> None:
+        self.meta[WAITING] = value
+
+    def write(self, data: memoryview) -> int:
+        """
+        Copies as much of `data` as fits into the ring, and returns the number of bytes copied.
+        """
+        tail = self.meta[TAIL]
+        count = min(len(data), self.size - (tail - self.meta[HEAD]))
+        start = tail % self.size
+        first = min(count, self.size - start)
+        self.data[start : start + first] = data[:first]
+        self.data[: count - first] = data[first:count]
+        self.meta[TAIL] = tail + count
+        return count
+
+    def read(self, size: int) -> bytes:
+        """
+        Takes up to `size` bytes out of the ring.
+        """
+        head = self.meta[HEAD]
+        count = min(size, self.meta[TAIL] - head)
+        start = head % self.size
+        first = min(count, self.size - start)
+        data = bytes(self.data[start : start + first]) + bytes(
+            self.data[: count - first]
+        )
+        self.meta[HEAD] = head + count
+        return data
+
+    def release(self) -> None:
+        self.meta.release()
+        self.data.release()
+
+
+class ShmSocket:
+    """
+    A connection over two rings in a shared memory segment, one in each direction.
+    The first ring carries the client's queries and the second one the server's replies.
+    """
+
+    def __init__(
+        self, control: socket.socket, memory: SharedMemory, server: bool
+    ) -> None:
+        """
+        Args:
+            control (socket.socket): The Unix domain socket the connection was set up over.
+                It is closed when the other side is gone, even if it did not close the connection.
+            memory (SharedMemory): The segment holding the two rings.
+            server (bool): Whether this is the server's side of the connection.
+        """
+        self.control = control
+        self.memory = memory
+        ring_bytes = RING_HEADER + RING_SIZE
+        queries = ShmRing(memory.buf[:ring_bytes])
+        replies = ShmRing(memory.buf[ring_bytes : 2 * ring_bytes])
+        self.rx, self.tx = (queries, replies) if server else (replies, queries)
+        self.closed = False
+
+    def ring_doorbell(self, ring: ShmRing) -> None:
+        """
+        Wakes the other side up if it sleeps until `ring` changes.
+        """
+        if ring.waiting:
+            try:
+                self.control.send(b"\x00", socket.MSG_DONTWAIT)
+            except (BlockingIOError, BrokenPipeError):
+                # the other side has doorbells to read already, or it is gone
+                pass
+
+    def wait(self, ring: ShmRing, ready: Callable[[], bool]) -> bool:
+        """
+        Waits until `ready` returns True, and returns False instead if the other side is gone.
+        """
+        for _ in range(SPIN_POLLS):
+            if ready():
+                return True
+        for _ in range(YIELD_POLLS):
+            if ready():
+                return True
+            os.sched_yield()
+        if ready():
+            return True
+        # only one side waits on a ring at a time: its reader when it is empty, or its writer when it is full
+        ring.waiting = True
+        try:
+            while not ready():
+                readable, _, _ = select.select([self.control], [], [], DOORBELL_TIMEOUT)
+                if not readable:
+                    continue
+                try:
+                    if not self.control.recv(4096, socket.MSG_DONTWAIT):
+                        return False
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    return False
+        finally:
+            ring.waiting = False
+        return True
+
+    def sendall(self, data: bytes | memoryview) -> None:
+        with memoryview(data) as view, view.cast("B") as remaining:
+            while remaining:
+                if self.rx.closed or not self.wait(self.tx, lambda: self.tx.free() > 0):
+                    raise BrokenPipeError("the other side closed the connection")
+                remaining = remaining[self.tx.write(remaining) :]
+                self.ring_doorbell(self.tx)
+
+    def recv(self, size: int) -> bytes:
+        """
+        Returns up to `size` bytes, waiting for at least one, or b"" if the other side closed the connection.
+        """
+        if not self.wait(self.rx, lambda: self.rx.available() > 0 or self.rx.closed):
+            return b""
+        data = self.rx.read(size)
+        self.ring_doorbell(self.rx)
+        return data
+
+    def getpeername(self):
+        return self.control.getpeername()
+
+    def shutdown(self, how: int) -> None:
+        self.tx.close()
+        self.ring_doorbell(self.tx)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.tx.close()
+        self.ring_doorbell(self.tx)
+        self.rx.release()
+        self.tx.release()
+        self.memory.close()
+        self.control.close()
+
+
+def recv_name(control: socket.socket) -> str:
+    length = control.recv(1)
+    name = b""
+    while length and len(name) < length[0]:
+        data = control.recv(length[0] - len(name))
+        if not data:
+            break
+        name += data
+    if not length or len(name) < length[0]:
+        raise ConnectionError("the server closed the connection during the handshake")
+    return name.decode()
+
+
+class ShmListener:
+    """
+    Accepts shared memory connections on a Unix domain socket.
+
+    For every client it creates a segment, sends its name over the socket, and removes the name
+    once the client has mapped it. The memory itself is freed when both sides close the connection.
+    A client which does not map the segment within HANDSHAKE_TIMEOUT is dropped.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+
+    def accept(self) -> tuple[ShmSocket, str]:
+        while True:
+            control, addr = self.sock.accept()
+            memory = SharedMemory(create=True, size=2 * (RING_HEADER + RING_SIZE))
+            control.settimeout(HANDSHAKE_TIMEOUT)
+            try:
+                name = memory.name.encode()
+                control.sendall(len(name).to_bytes(1, "big") + name)
+                mapped = control.recv(1)  # the client mapped the segment
+            except OSError:
+                mapped = b""
+            finally:
+                memory.unlink()
+            if mapped:
+                control.settimeout(None)
+                return ShmSocket(control, memory, server=True), addr
+            # the client stalled or left during the handshake
+            memory.close()
+            control.close()
+
+    def close(self) -> None:
+        self.sock.close()
+
+
+def connect(url: str) -> socket.socket | ShmSocket:
+    """
+    Connects to the oracle server at `url`.
+    """
+    scheme, address = parse_url(url)
+    if scheme == "tcp":
+        return socket.create_connection(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    if scheme == "unix":
+        return sock
+    memory = SharedMemory(recv_name(sock))
+    # the server removes the segment's name, so this process must not remove it again at exit
+    resource_tracker.unregister(memory._name, "shared_memory")
+    sock.sendall(b"\x01")
+    return ShmSocket(sock, memory, server=False)
+
+
+def listen(url: str, reuse_port: bool = False) -> socket.socket | ShmListener:
+    """
+    Returns a listener for the oracle server at `url`, with the `accept` and `close` methods of a socket.
+
+    Args:
+        url (str): The URL to serve.
+        reuse_port (bool, optional): If True, other processes may listen on the same TCP port as well
+            (SO_REUSEPORT). Defaults to False.
+    """
+    scheme, address = parse_url(url)
+    if scheme == "tcp":
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(address)
+        sock.listen()
+        return sock
+
+    # a server that was stopped leaves its socket file behind
+    if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+        os.unlink(address)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(address)
+    sock.listen()
+    return sock if scheme == "unix" else ShmListener(sock)